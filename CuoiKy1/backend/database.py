@@ -1,41 +1,253 @@
+import os
+import threading
+import time
+from collections import deque
 import mysql.connector
+from mysql.connector import errors
 from datetime import datetime
 
-db = mysql.connector.connect(
-    host="localhost",
-    user="root",
-    password="",
-    database="chat_db"
+# Cấu hình MySQL / MariaDB (đổi bằng biến môi trường khi chạy thử trên máy khác)
+DB_CONFIG = dict(
+    host=os.environ.get("DB_HOST", "localhost"),
+    port=int(os.environ.get("DB_PORT", "3306")),
+    user=os.environ.get("DB_USER", "root"),
+    password=os.environ.get("DB_PASSWORD", ""),
+    database=os.environ.get("DB_NAME", "chat_db"),
+    # Mỗi câu lệnh tự commit: SELECT không giữ snapshot REPEATABLE READ cũ trên connection của pool
+    autocommit=True
 )
+POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "8"))
+POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "5"))         # giây chờ tối đa khi pool hết connection
+HEALTH_CHECK_IDLE = float(os.environ.get("DB_HEALTH_CHECK_IDLE", "30"))  # connection rảnh lâu hơn thì ping trước khi dùng
+
+# Số tin nhắn đọc mỗi lần = số tin nhắn trong 1 frame lịch sử gửi cho client (giống db.py)
+HISTORY_BATCH = 200
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS users (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        username VARCHAR(64) NOT NULL UNIQUE,
+        password VARCHAR(255) NOT NULL,
+        role VARCHAR(16) NOT NULL DEFAULT 'user'
+    )""",
+    """CREATE TABLE IF NOT EXISTS messages (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        room VARCHAR(64) NOT NULL DEFAULT 'general',
+        username VARCHAR(64) NOT NULL,
+        content MEDIUMTEXT NOT NULL,
+        time VARCHAR(16) NOT NULL,
+        INDEX idx_messages_room_id (room, id)
+    )"""
+]
+SQL_HAS_ROOM = ("SELECT COUNT(*) FROM information_schema.columns "
+                "WHERE table_schema=DATABASE() AND table_name='messages' AND column_name='room'")
+SQL_ADD_ROOM = ("ALTER TABLE messages ADD COLUMN room VARCHAR(64) NOT NULL DEFAULT 'general' AFTER id, "
+                "ADD INDEX idx_messages_room_id (room, id)")
+SQL_ADD_ADMIN = "INSERT IGNORE INTO users (username,password,role) VALUES (%s,%s,'admin')"
+
+SQL_USER_EXISTS = "SELECT 1 FROM users WHERE username=%s"
+SQL_CHECK_LOGIN = "SELECT role FROM users WHERE username=%s AND password=%s"
+SQL_REGISTER = "INSERT INTO users (username,password) VALUES (%s,%s)"
+SQL_SAVE_MESSAGE = "INSERT INTO messages (room,username,content,time) VALUES (%s,%s,%s,%s)"
+SQL_LOAD_MESSAGES = "SELECT username,content,time FROM messages WHERE room=%s ORDER BY id DESC LIMIT %s"
+SQL_LAST_ID = "SELECT COALESCE(MAX(id), 0) FROM messages"
+SQL_HISTORY_BATCH = ("SELECT id,username,content,time FROM messages "
+                     "WHERE room=%s AND id>%s AND id<=%s ORDER BY id LIMIT %s")
+
+class PooledConnection:
+    def __init__(self):
+        self.cnx = mysql.connector.connect(**DB_CONFIG)
+        self.statements = {}   # sql -> cursor đã prepare trên server (prepare 1 lần / connection)
+        self.last_used = time.monotonic()
+
+    def prepared(self, sql):
+        cur = self.statements.get(sql)
+        if cur is None:
+            cur = self.statements[sql] = self.cnx.cursor(prepared=True)
+        return cur
+
+    def close(self):
+        try:
+            self.cnx.close()
+        except errors.Error:
+            pass
+
+class ConnectionPool:
+    def __init__(self, size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        self.size = size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = []                # connection rảnh, lấy cái vừa trả (còn "ấm") trước
+        self.waiters = deque()        # thread đang chờ, được giao connection theo thứ tự đến
+        self.opened = 0               # số connection đang giữ chỗ trong pool
+        self.in_use = 0
+        self.peak = 0
+        self.created = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_ms = 0.0
+        self.max_wait_ms = 0.0
+        self.timeouts = 0
+        self.health_checks = 0
+        self.reconnects = 0
+
+    def acquire(self):
+        conn = waiter = None
+        with self.lock:
+            self.checkouts += 1
+            if self.idle or self.opened < self.size:
+                if self.idle:
+                    conn = self.idle.pop()
+                else:
+                    self.opened += 1
+                self.in_use += 1
+                self.peak = max(self.peak, self.in_use)
+            else:
+                waiter = [threading.Event(), None]
+                self.waiters.append(waiter)
+        if waiter is not None:
+            # Pool bão hòa: chờ connection được trả lại
+            started = time.perf_counter()
+            got = waiter[0].wait(self.timeout)
+            waited = (time.perf_counter() - started) * 1000
+            with self.lock:
+                self.waits += 1
+                self.wait_ms += waited
+                self.max_wait_ms = max(self.max_wait_ms, waited)
+                if not got and not waiter[0].is_set():
+                    self.waiters.remove(waiter)
+                    self.timeouts += 1
+                    raise errors.PoolError("Hết connection MySQL (pool size %d)" % self.size)
+            conn = waiter[1]
+        try:
+            return self._checkout(conn)
+        except BaseException:
+            self.release(None, broken=True)
+            raise
+
+    def _checkout(self, conn):
+        if conn is None:
+            with self.lock:
+                self.created += 1
+            return PooledConnection()
+        if time.monotonic() - conn.last_used > HEALTH_CHECK_IDLE:
+            # Connection rảnh lâu có thể đã bị server cắt (wait_timeout): ping, hỏng thì mở lại
+            with self.lock:
+                self.health_checks += 1
+            try:
+                conn.cnx.ping(reconnect=False)
+            except errors.Error:
+                conn.close()
+                with self.lock:
+                    self.reconnects += 1
+                    self.created += 1
+                return PooledConnection()
+        return conn
+
+    def release(self, conn, broken=False):
+        if broken:
+            if conn is not None:
+                conn.close()
+            conn = None   # chỗ trống: người nhận tự mở connection mới
+        else:
+            conn.last_used = time.monotonic()
+        with self.lock:
+            if self.waiters:
+                # Giao thẳng cho thread chờ lâu nhất (không để thread mới đến chen ngang)
+                waiter = self.waiters.popleft()
+                waiter[1] = conn
+                waiter[0].set()
+                return
+            self.in_use -= 1
+            if conn is None:
+                self.opened -= 1
+            else:
+                self.idle.append(conn)
+
+    def run(self, sql, params, fetch=False):
+        conn = self.acquire()
+        try:
+            cur = conn.prepared(sql)
+            cur.execute(sql, params)
+            rows = cur.fetchall() if fetch else None
+        except BaseException as e:
+            # Mất kết nối giữa chừng: bỏ connection này, lần sau pool mở cái mới
+            self.release(conn, isinstance(e, (errors.OperationalError, errors.InterfaceError)))
+            raise
+        self.release(conn)
+        return rows
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": self.size,
+                "created": self.created,
+                "in_use": self.in_use,
+                "idle": len(self.idle),
+                "waiting": len(self.waiters),
+                "peak_in_use": self.peak,
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "avg_wait_ms": round(self.wait_ms / self.waits, 3) if self.waits else 0.0,
+                "max_wait_ms": round(self.max_wait_ms, 3),
+                "timeouts": self.timeouts,
+                "health_checks": self.health_checks,
+                "reconnects": self.reconnects
+            }
+
+pool = ConnectionPool()
+
+# Cùng giao diện với db.py: server.py chọn 1 trong 2 bằng DB_BACKEND, gọi qua asyncio.to_thread
+def init_db():
+    conn = pool.acquire()
+    try:
+        cur = conn.cnx.cursor()
+        for sql in SCHEMA:
+            cur.execute(sql)
+        cur.execute(SQL_HAS_ROOM)
+        if not cur.fetchone()[0]:
+            # Bảng cũ chưa chia phòng: tin nhắn cũ thuộc phòng general
+            cur.execute(SQL_ADD_ROOM)
+        cur.execute(SQL_ADD_ADMIN, ("admin", "8c6976e5b5410415bde908bd4dee15dfb167a9c873fc4bb8a81f6f2ab448a918"))  # pass: admin
+        cur.close()
+    except BaseException as e:
+        pool.release(conn, isinstance(e, (errors.OperationalError, errors.InterfaceError)))
+        raise
+    pool.release(conn)
+
+def check_user(u):
+    return bool(pool.run(SQL_USER_EXISTS, (u,), fetch=True))
 
 def check_login(u, p):
-    cur = db.cursor()
-    cur.execute(
-        "SELECT role FROM users WHERE username=%s AND password=%s",
-        (u, p)
-    )
-    r = cur.fetchone()
-    return r[0] if r else None
-
-def register_user(u, p):
-    cur = db.cursor()
-    cur.execute(
-        "INSERT INTO users (username,password) VALUES (%s,%s)",
-        (u, p)
-    )
-    db.commit()
-
-def save_message(u, m):
-    cur = db.cursor()
-    cur.execute(
-        "INSERT INTO messages (username,content,time) VALUES (%s,%s,%s)",
-        (u, m, datetime.now().strftime("%H:%M:%S"))
-    )
-    db.commit()
-
-def load_messages():
-    cur = db.cursor()
-    cur.execute(
-        "SELECT username,content,time FROM messages ORDER BY id DESC LIMIT 50"
-    )
-    return cur.fetchall()[::-1]
+    r = pool.run(SQL_CHECK_LOGIN, (u, p), fetch=True)
+    return r[0][0] if r else None
+
+def create_user(u, p):
+    pool.run(SQL_REGISTER, (u, p))
+
+def save_message(room, u, m):
+    pool.run(SQL_SAVE_MESSAGE, (room, u, m, datetime.now().strftime("%H:%M")))
+
+def _message(row):
+    return {"sender": row[0], "message": row[1], "time": row[2][:5]}
+
+def iter_messages(room, batch=HISTORY_BATCH):
+    # Generator: chỉ chạy khi next() lần đầu (trên thread của server), không phải lúc tạo
+    # Chốt id lớn nhất: tin nhắn lưu trong lúc đang đọc không bị lẫn vào lịch sử
+    last_id = pool.run(SQL_LAST_ID, (), fetch=True)[0][0]
+    after = 0
+    while True:
+        # Mỗi lô 1 câu (keyset theo id): không giữ connection của pool giữa 2 lô
+        rows = pool.run(SQL_HISTORY_BATCH, (room, after, last_id, batch), fetch=True)
+        if not rows:
+            return
+        after = rows[-1][0]
+        yield [_message(r[1:]) for r in rows]
+        if len(rows) < batch:
+            return
+
+def load_messages(room, limit=50):
+    return [_message(r) for r in pool.run(SQL_LOAD_MESSAGES, (room, limit), fetch=True)[::-1]]
+
+def pool_stats():
+    return pool.stats()
@@ -1,6 +1,6 @@
 import sqlite3
 
-# Kết nối database
+# Kết nối database (server gọi các hàm qua asyncio.to_thread: mỗi lần gọi dùng cursor riêng)
 conn = sqlite3.connect("chat.db", check_same_thread=False)
 cur = conn.cursor()
 
@@ -37,31 +37,46 @@ def init_db():
 
 def save_message(room, sender, message):
     # Thời gian sẽ tự động được SQLite điền vào cột created_at
-    cur.execute(
+    conn.execute(
         "INSERT INTO messages (room, sender, message) VALUES (?,?,?)",
         (room, sender, message)
     )
     conn.commit()
 
+# Số tin nhắn đọc mỗi lần (fetchmany) = số tin nhắn trong 1 frame lịch sử gửi cho client
+HISTORY_BATCH = 200
+
+def iter_messages(room, batch=HISTORY_BATCH):
+    # Generator: chỉ chạy khi next() lần đầu (trong asyncio.to_thread của server), không chạy trên event loop
+    # Cursor riêng, đọc từng lô: bộ nhớ chỉ giữ 1 lô dù phòng có bao nhiêu tin nhắn
+    c = conn.cursor()
+    try:
+        # Chốt id lớn nhất: tin nhắn lưu trong lúc đang đọc không bị lẫn vào lịch sử
+        c.execute("SELECT COALESCE(MAX(id), 0) FROM messages")
+        last_id = c.fetchone()[0]
+        c.execute("""
+            SELECT sender, message, strftime('%H:%M', created_at, 'localtime') 
+            FROM messages 
+            WHERE room=? AND id<=? 
+            ORDER BY id
+        """, (room, last_id))
+        while True:
+            rows = c.fetchmany(batch)
+            if not rows:
+                break
+            # Trả về có cả 'time' để Frontend hiển thị đúng giờ cũ
+            yield [{"sender": r[0], "message": r[1], "time": r[2]} for r in rows]
+    finally:
+        c.close()
+
 def load_messages(room):
-    # 🔥 SỬA: Lấy thêm cột thời gian đã được định dạng HH:MM
-    cur.execute("""
-        SELECT sender, message, strftime('%H:%M', created_at, 'localtime') 
-        FROM messages 
-        WHERE room=? 
-        ORDER BY id
-    """, (room,))
-    
-    rows = cur.fetchall()
-    # Trả về có cả 'time' để Frontend hiển thị đúng giờ cũ
-    return [{"sender": r[0], "message": r[1], "time": r[2]} for r in rows]
+    return [m for chunk in iter_messages(room) for m in chunk]
 
 def check_user(username):
-    cur.execute("SELECT 1 FROM users WHERE username=?", (username,))
-    return cur.fetchone() is not None
+    return conn.execute("SELECT 1 FROM users WHERE username=?", (username,)).fetchone() is not None
 
 def create_user(username, password):
-    cur.execute(
+    conn.execute(
         "INSERT INTO users (username, password) VALUES (?,?)",
         (username, password)
     )
@@ -69,8 +84,7 @@ def create_user(username, password):
 
 def verify_user(username, password):
     # Password truyền vào phải là hash rồi (xử lý ở server.py)
-    cur.execute(
+    return conn.execute(
         "SELECT 1 FROM users WHERE username=? AND password=?",
         (username, password)
-    )
-    return cur.fetchone() is not None
\ No newline at end of file
+    ).fetchone() is not None
\ No newline at end of file
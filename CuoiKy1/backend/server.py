@@ -2,17 +2,27 @@ import asyncio
 import websockets
 import json
 import hashlib
-from collections import defaultdict
+import os
+from collections import defaultdict, deque
 from datetime import datetime
 
 # --- 1. KẾT NỐI DATABASE ---
+# DB_BACKEND=mysql: MySQL/MariaDB qua pool connection (database.py), mặc định SQLite (db.py)
+# Cả 2 cùng giao diện; mọi lời gọi DB trong handler chạy qua asyncio.to_thread
+DB_BACKEND = os.environ.get("DB_BACKEND", "sqlite")
+
 # Tự động tìm file db.py, nếu không thấy sẽ chạy chế độ giả lập
 try:
-    import db
+    if DB_BACKEND == "mysql":
+        import database as db
+    else:
+        import db
     db.init_db()
-    print("✅ [SYSTEM] Database đã kết nối thành công!")
-except ImportError:
-    print("❌ [ERROR] Không tìm thấy file db.py! Đang chạy chế độ giả lập (không lưu tin nhắn lâu dài).")
+    print(f"✅ [SYSTEM] Database ({DB_BACKEND}) đã kết nối thành công!")
+except ImportError as e:
+    if DB_BACKEND == "mysql":
+        raise  # đã chọn MySQL mà thiếu mysql-connector-python: dừng, không chạy giả lập (nhận mọi login)
+    print(f"❌ [ERROR] Không nạp được database ({e})! Đang chạy chế độ giả lập (không lưu tin nhắn lâu dài).")
     # Mock class để server không bị crash nếu thiếu file db
     class db:
         @staticmethod
@@ -22,12 +32,23 @@ except ImportError:
         @staticmethod
         def load_messages(r): return []
         @staticmethod
+        def iter_messages(r): return (m for m in ())
+        @staticmethod
         def check_user(u): return True # Luôn cho phép đăng nhập nếu không có DB
         @staticmethod
         def create_user(u, p): pass
 
 clients = {}            # Quản lý kết nối: ws -> {username, room}
 rooms = defaultdict(set)  # Quản lý phòng: room -> set(ws)
+loading = {}            # ws đang nhận lịch sử -> Pending: tin nhắn mới đến trong lúc đó (gửi sau lịch sử), None = tràn
+
+HISTORY_BUFFER_MAX = 500                 # số tin nhắn tối đa giữ lại cho 1 kết nối trong lúc gửi lịch sử
+HISTORY_BUFFER_BYTES = 4 * 1024 * 1024   # tổng kích thước tối đa (tin nhắn ảnh base64 có thể vài MB)
+HISTORY_RESYNC_MAX = 2                   # số lần gửi lại lịch sử khi tràn, quá thì đóng kết nối
+
+class Pending(deque):
+    """Frame JSON (đã encode) chờ gửi sau lịch sử, kèm tổng số byte"""
+    size = 0
 
 # --- 2. HÀM HỖ TRỢ ---
 def get_time():
@@ -41,12 +62,51 @@ async def broadcast(room, data):
     
     # Tạo bản sao danh sách để gửi tin (tránh lỗi khi danh sách thay đổi đột ngột)
     connections = list(rooms[room]) 
+    frame = json.dumps(data)  # encode 1 lần (ASCII: số ký tự = số byte)
     for ws in connections:
+        if ws in loading:
+            pending = loading[ws]
+            if pending is None:
+                continue
+            if len(pending) >= HISTORY_BUFFER_MAX or pending.size + len(frame) > HISTORY_BUFFER_BYTES:
+                loading[ws] = None   # tràn: bỏ buffer, send_history gửi lại lịch sử từ đầu
+            else:
+                pending.append(frame)
+                pending.size += len(frame)
+            continue
         try:
-            await ws.send(json.dumps(data))
+            await ws.send(frame)
         except:
             rooms[room].discard(ws)
 
+async def send_history(ws, room, history):
+    # Gửi lịch sử thành nhiều frame nhỏ (mỗi frame 1 lô fetchmany), không dựng cả phòng thành 1 list
+    try:
+        for _ in range(HISTORY_RESYNC_MAX + 1):
+            while True:
+                # fetchmany chạy ở thread riêng, không chặn event loop
+                chunk = await asyncio.to_thread(next, history, None)
+                if chunk is None:
+                    break
+                await ws.send(json.dumps({"type": "history", "room": room, "messages": chunk}))
+            await ws.send(json.dumps({"type": "history_end", "room": room}))
+            # Gửi tiếp các tin nhắn đến trong lúc đang gửi lịch sử (vẫn giữ thứ tự)
+            while loading[ws]:
+                frame = loading[ws].popleft()
+                loading[ws].size -= len(frame)
+                await ws.send(frame)
+            if loading[ws] is not None:
+                return
+            # Buffer tràn (phòng quá đông): đọc lại lịch sử mới nhất, client xóa khung chat rồi vẽ lại
+            history.close()
+            loading[ws] = Pending()
+            history = db.iter_messages(room)
+            await ws.send(json.dumps({"type": "resync", "room": room}))
+        await ws.close(1013, "Phòng quá đông, vui lòng thử lại")
+    finally:
+        history.close()
+        loading.pop(ws, None)
+
 # --- 3. XỬ LÝ CHÍNH (HANDLER) ---
 async def handler(ws):
     clients[ws] = None
@@ -68,7 +128,7 @@ async def handler(ws):
                 hashed = hashlib.sha256(password.encode()).hexdigest()
                 
                 try:
-                    db.create_user(username, hashed)
+                    await asyncio.to_thread(db.create_user, username, hashed)
                     await ws.send(json.dumps({"type": "register_ok"}))
                     print(f"📝 Đăng ký mới thành công: {username}")
                 except Exception as e:
@@ -80,20 +140,22 @@ async def handler(ws):
                 username = data["username"]
                 room = data.get("room", "general")
                 
-                if db.check_user(username):
+                if await asyncio.to_thread(db.check_user, username):
                     clients[ws] = {"username": username, "room": room}
                     rooms[room].add(ws)
+                    loading[ws] = Pending()
 
-                    # Lấy tin nhắn cũ từ DB gửi cho user
-                    history = db.load_messages(room)
+                    # Lấy tin nhắn cũ từ DB gửi cho user (từng lô, sau login_success)
+                    history = db.iter_messages(room)
 
                     await ws.send(json.dumps({
                         "type": "login_success",
                         "username": username,
                         "room": room,
                         "online": online(room),
-                        "history": history
+                        "history": []
                     }))
+                    await send_history(ws, room, history)
 
                     # Báo cho cả phòng biết có người mới vào
                     await broadcast(room, {"type": "online", "online": online(room)})
@@ -123,9 +185,9 @@ async def handler(ws):
                     log_msg = msg if len(msg) < 50 else "(Hình ảnh/Tin dài...)"
                     print(f"💬 [{room}] {sender}: {log_msg}") 
 
-                    # --- LƯU SAU (Để không chặn server) ---
+                    # --- LƯU SAU (trên thread riêng, không chặn server) ---
                     try:
-                        db.save_message(room, sender, msg)
+                        await asyncio.to_thread(db.save_message, room, sender, msg)
                     except Exception as e:
                         print(f"⚠️ Lỗi lưu tin nhắn vào DB: {e}")
 
@@ -142,6 +204,8 @@ async def handler(ws):
                         # Vào phòng mới
                         rooms[new_room].add(ws)
                         user_info["room"] = new_room
+                        loading[ws] = Pending()
+                        history = db.iter_messages(new_room)
                         
                         # Cập nhật số lượng online phòng cũ
                         await broadcast(old_room, {"type": "online", "online": online(old_room)})
@@ -151,8 +215,9 @@ async def handler(ws):
                             "type": "switched",
                             "room": new_room,
                             "online": online(new_room),
-                            "history": db.load_messages(new_room)
+                            "history": []
                         }))
+                        await send_history(ws, new_room, history)
                         
                         # Cập nhật số lượng online phòng mới
                         await broadcast(new_room, {"type": "online", "online": online(new_room)})
@@ -165,6 +230,7 @@ async def handler(ws):
     finally:
         # Dọn dẹp khi user thoát
         user_info = clients.pop(ws, None)
+        loading.pop(ws, None)
         if user_info:
             room = user_info["room"]
             rooms[room].discard(ws)
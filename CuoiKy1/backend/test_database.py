@@ -0,0 +1,125 @@
+# Test database.py với MySQL/MariaDB thật (bỏ qua nếu không kết nối được):
+#   DB_HOST=... DB_USER=... DB_PASSWORD=... python -m pytest test_database.py
+# Dùng database riêng (mặc định chat_db_test) để không đụng dữ liệu chat_db.
+import os
+import threading
+import uuid
+
+import pytest
+
+mysql_connector = pytest.importorskip("mysql.connector")
+os.environ.setdefault("DB_NAME", "chat_db_test")
+
+TEST_DB = os.environ["DB_NAME"]
+
+def _server_config():
+    return dict(
+        host=os.environ.get("DB_HOST", "localhost"),
+        port=int(os.environ.get("DB_PORT", "3306")),
+        user=os.environ.get("DB_USER", "root"),
+        password=os.environ.get("DB_PASSWORD", ""),
+        connection_timeout=3
+    )
+
+@pytest.fixture(scope="module")
+def database():
+    try:
+        cnx = mysql_connector.connect(**_server_config())
+    except mysql_connector.Error as e:
+        pytest.skip(f"Không kết nối được MySQL/MariaDB: {e}")
+    cnx.cursor().execute(f"CREATE DATABASE IF NOT EXISTS `{TEST_DB}` CHARACTER SET utf8mb4")
+    cnx.close()
+
+    import database
+    database.pool = database.ConnectionPool(size=2, timeout=2)
+    database.init_db()
+    yield database
+    database.pool = database.ConnectionPool()
+
+def _name():
+    return "t_" + uuid.uuid4().hex[:12]
+
+def test_register_then_login(database):
+    u = _name()
+    assert not database.check_user(u)
+    assert database.check_login(u, "pw") is None
+    database.create_user(u, "pw")
+    assert database.check_user(u)
+    assert database.check_login(u, "pw") == "user"
+    assert database.check_login(u, "wrong") is None
+    assert database.check_user("admin")   # tài khoản mặc định của init_db
+
+def test_reads_see_writes_from_other_connections(database):
+    # Giữ 2 connection khác nhau: A đọc trước, B ghi, A đọc lại phải thấy dữ liệu mới
+    pool = database.pool
+    a, b = pool.acquire(), pool.acquire()
+    pool.release(b)
+    pool.release(a)              # LIFO: lần lấy tiếp theo là A
+    room = _name()
+    database.load_messages(room) # A mở (và đóng) 1 lượt đọc
+
+    a = pool.acquire()           # giữ A để câu ghi chạy trên B
+    try:
+        u, text = _name(), "xin chào " + uuid.uuid4().hex
+        database.create_user(u, "pw")
+        database.save_message(room, u, text)
+    finally:
+        pool.release(a)
+
+    assert database.check_login(u, "pw") == "user"
+    assert [(m["sender"], m["message"]) for m in database.load_messages(room, 5)] == [(u, text)]
+
+def test_load_messages_order_and_limit(database):
+    room, u = _name(), _name()
+    for i in range(5):
+        database.save_message(room, u, f"m{i}")
+    database.save_message(_name(), u, "phòng khác")
+    rows = database.load_messages(room, 3)
+    assert [m["message"] for m in rows] == ["m2", "m3", "m4"]
+    assert len(rows[0]["time"]) == 5   # HH:MM
+
+def test_iter_messages_batches_and_snapshot(database):
+    room, u = _name(), _name()
+    for i in range(7):
+        database.save_message(room, u, f"m{i}")
+    database.save_message(_name(), u, "phòng khác")
+
+    history = database.iter_messages(room, batch=3)
+    first = next(history)
+    database.save_message(room, u, "sau khi bắt đầu đọc")   # không lẫn vào lịch sử đang đọc
+    chunks = [first] + list(history)
+    assert [len(c) for c in chunks] == [3, 3, 1]
+    assert [m["message"] for c in chunks for m in c] == [f"m{i}" for i in range(7)]
+
+def test_pool_under_concurrency(database):
+    before = database.pool_stats()["checkouts"]
+    errors = []
+
+    def worker():
+        try:
+            for _ in range(10):
+                database.load_messages("general", 1)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    stats = database.pool_stats()
+    assert not errors
+    assert stats["checkouts"] - before == 80
+    assert stats["peak_in_use"] <= stats["size"] == 2
+    assert stats["in_use"] == 0
+    assert stats["waits"] > 0
+
+def test_broken_connection_is_replaced(database):
+    conn = database.pool.acquire()
+    conn.cnx.close()             # giả lập server cắt kết nối
+    database.pool.release(conn)
+    reconnects = database.pool_stats()["reconnects"]
+    database.pool.idle[-1].last_used = 0   # bắt buộc health check lần lấy tiếp
+    database.load_messages("general", 1)
+    assert database.pool_stats()["reconnects"] == reconnects + 1
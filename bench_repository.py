@@ -0,0 +1,66 @@
+"""Đo tốc độ repository.py (cùng kịch bản cho mọi backend)
+
+    python bench_repository.py                      # SQLite trên file DB tạm
+    CHAT_STORAGE=mysql python bench_repository.py   # MySQL theo cấu hình MYSQL_*
+Tùy chỉnh: BENCH_MESSAGES (số tin nhắn ghi), BENCH_CONCURRENCY (số coroutine chạy song song).
+"""
+import asyncio
+import os
+import tempfile
+import time
+
+# Mặc định không đụng chat.db thật
+os.environ.setdefault("CHAT_DB", os.path.join(tempfile.mkdtemp(prefix="chat-bench-"), "chat.db"))
+
+from repository import create_repository
+
+BENCH_MESSAGES = int(os.environ.get("BENCH_MESSAGES", "2000"))
+BENCH_CONCURRENCY = int(os.environ.get("BENCH_CONCURRENCY", "50"))
+
+async def timed(label, count, make_call):
+    """Chạy count lời gọi, tối đa BENCH_CONCURRENCY cùng lúc, in số thao tác/giây"""
+    gate = asyncio.Semaphore(BENCH_CONCURRENCY)
+    latencies = []
+
+    async def one(i):
+        async with gate:
+            started = time.perf_counter()
+            result = await make_call(i)
+            latencies.append((time.perf_counter() - started) * 1000)
+            return result
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(one(i) for i in range(count)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    print(f"  {label:<22} {count / elapsed:>9.0f} op/s   p50 {latencies[len(latencies) // 2]:6.2f} ms"
+          f"   p99 {latencies[int(len(latencies) * 0.99)]:6.2f} ms")
+    return results
+
+async def main():
+    repo = create_repository()
+    repo.init()
+    await repo.open()
+    print(f"📊 {repo.name}: {BENCH_MESSAGES} tin nhắn, {BENCH_CONCURRENCY} coroutine song song")
+    try:
+        room = f"bench-{os.getpid()}"
+        ids = await timed("save_message", BENCH_MESSAGES,
+                          lambda i: repo.save_message(room, "bench", f"tin nhắn {i}"))
+        await timed("load_messages", BENCH_MESSAGES // 4,
+                    lambda i: repo.load_messages(room, 30))
+        await timed("load_messages(before)", BENCH_MESSAGES // 4,
+                    lambda i: repo.load_messages(room, 30, before_id=ids[i * 4 % len(ids)]))
+        await timed("load_messages_since", BENCH_MESSAGES // 4,
+                    lambda i: repo.load_messages_since(room, ids[-(i % 100) - 1]))
+        await timed("save_private_message", BENCH_MESSAGES // 4,
+                    lambda i: repo.save_private_message("bench", f"user{i % 10}", "hi"))
+        await timed("load_private_messages", BENCH_MESSAGES // 4,
+                    lambda i: repo.load_private_messages("bench", f"user{i % 10}"))
+        await timed("get_password_hash", BENCH_MESSAGES // 4,
+                    lambda i: repo.get_password_hash("admin"))
+        print(f"  stats: {repo.stats()}")
+    finally:
+        await repo.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,99 @@
+import hashlib
+import os
+import re
+import tempfile
+
+from codec import split_data_url
+
+# Kho file đính kèm trên ổ đĩa, khóa = SHA-256 của nội dung (trùng nội dung chỉ lưu 1 lần)
+BLOB_DIR = os.environ.get("BLOB_DIR", "blobs")
+BLOB_PREFIX = "blob:"
+DEFAULT_MIME = "application/octet-stream"
+
+# MIME do client gửi: chỉ chấp nhận dạng type/subtype (không khoảng trắng, không xuống dòng)
+MIME_RE = re.compile(r"^[\w.+-]+/[\w.+-]+$", re.ASCII)
+
+# Chỉ ảnh raster được hiển thị thẳng trên trang; svg/html/... luôn tải về dạng file
+INLINE_MIME = {"image/png", "image/jpeg", "image/gif", "image/webp"}
+
+def normalize_mime(mime):
+    """MIME hợp lệ (chữ thường), sai định dạng thì coi là file nhị phân"""
+    if isinstance(mime, str) and MIME_RE.match(mime):
+        return mime.lower()
+    return DEFAULT_MIME
+
+def blob_path(digest):
+    """Đường dẫn file của blob: blobs/ab/abcdef..."""
+    return os.path.join(BLOB_DIR, digest[:2], digest)
+
+def put_blob(data):
+    """Lưu bytes vào kho, trả về mã hash (đã có thì không ghi lại)"""
+    digest = hashlib.sha256(data).hexdigest()
+    path = blob_path(digest)
+    if os.path.exists(path):
+        return digest
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Ghi ra file tạm rồi rename để không bao giờ có blob ghi dở
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return digest
+
+def commit_file(path, digest):
+    """Đưa file đã ghi xong (cùng ổ đĩa với kho) vào kho dưới tên hash, trùng thì xóa file"""
+    target = blob_path(digest)
+    if os.path.exists(target):
+        os.unlink(path)
+        return digest
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    os.replace(path, target)
+    return digest
+
+def read_blob(digest):
+    """Đọc nội dung blob"""
+    with open(blob_path(digest), "rb") as f:
+        return f.read()
+
+def read_blob_range(digest, start, length):
+    """Đọc 1 đoạn của blob (HTTP Range)"""
+    with open(blob_path(digest), "rb") as f:
+        f.seek(start)
+        return f.read(length)
+
+def is_valid_digest(digest):
+    return isinstance(digest, str) and len(digest) == 64 and all(c in "0123456789abcdef" for c in digest)
+
+def store_attachment(data, mime, name=None):
+    """Lưu file đính kèm, trả về (message tham chiếu, msg_type, hash)
+
+    Ảnh: "blob:<hash>"; file khác: "FILE|<tên>|blob:<hash>" (giống định dạng client cũ).
+    """
+    digest = put_blob(data)
+    return attachment_ref(digest, mime, name) + (digest,)
+
+def attachment_ref(digest, mime, name=None):
+    """(message tham chiếu, msg_type) của blob"""
+    ref = BLOB_PREFIX + digest
+    if mime in INLINE_MIME and not name:
+        return ref, "image"
+    return f"FILE|{name or 'file'}|{ref}", "file"
+
+def split_inline_attachment(message):
+    """Tin nhắn chứa data URL -> (bytes, mime, tên file), None nếu là text thường"""
+    name = None
+    if isinstance(message, str) and message.startswith("FILE|"):
+        parts = message.split("|", 2)
+        if len(parts) != 3:
+            return None
+        name, message = parts[1], parts[2]
+    parsed = split_data_url(message)
+    if parsed is None:
+        return None
+    mime, data = parsed
+    return data, normalize_mime(mime.split(";", 1)[0]), name
@@ -0,0 +1,62 @@
+import asyncio
+import json
+import os
+import socket
+
+# Broker pub/sub: chuyển mỗi event (1 dòng JSON) tới tất cả node còn lại
+# Chạy riêng: python broker.py  (nghe CHAT_BROKER_HOST:CHAT_BROKER_PORT)
+BROKER_HOST = os.environ.get("CHAT_BROKER_HOST", "127.0.0.1")
+BROKER_PORT = int(os.environ.get("CHAT_BROKER_PORT", "8766"))
+LINE_LIMIT = 16 * 1024 * 1024  # tin nhắn có ảnh base64 có thể rất dài
+
+def bind_unix_socket(path):
+    """Tạo Unix socket cho broker (gọi trước khi fork worker)"""
+    if os.path.exists(path):
+        os.unlink(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(128)
+    return sock
+
+async def run_broker(sock=None, host=BROKER_HOST, port=BROKER_PORT):
+    """Chạy broker trên Unix socket có sẵn (sock) hoặc TCP host:port"""
+    peers = {}  # writer -> node id
+
+    def relay(line, source):
+        for writer in list(peers):
+            if writer is not source:
+                writer.write(line)
+
+    async def on_node(reader, writer):
+        peers[writer] = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if peers[writer] is None:
+                    peers[writer] = json.loads(line).get("node")
+                relay(line, writer)
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            node = peers.pop(writer)
+            writer.close()
+            if node is not None:
+                # Báo các node khác xóa presence của node đã chết
+                down = {"kind": "node_down", "node": node}
+                relay(json.dumps(down).encode() + b"\n", None)
+
+    if sock is not None:
+        server = await asyncio.start_unix_server(on_node, sock=sock, limit=LINE_LIMIT)
+    else:
+        server = await asyncio.start_server(on_node, host, port, limit=LINE_LIMIT)
+        print(f"📮 Broker đang chạy tại {host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(run_broker())
+    except KeyboardInterrupt:
+        pass
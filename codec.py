@@ -0,0 +1,123 @@
+import base64
+import json
+
+# Thư viện binary là tùy chọn: thiếu thì chỉ dùng JSON
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+def split_data_url(text):
+    """Tách data URL (data:<mime>;base64,...) thành (mime, bytes), None nếu không phải"""
+    if not isinstance(text, str) or not text.startswith("data:"):
+        return None
+    header, sep, payload = text.partition(",")
+    if not sep or not header.endswith(";base64"):
+        return None
+    try:
+        return header[len("data:"):-len(";base64")], base64.b64decode(payload)
+    except ValueError:
+        return None
+
+def _to_raw(item):
+    """Tin nhắn chứa data URL -> bản sao với attachment dạng bytes"""
+    if not isinstance(item, dict):
+        return item
+    parsed = split_data_url(item.get("message"))
+    if parsed is None:
+        return item
+    item = dict(item)
+    item["message"] = ""
+    item["mime"], item["attachment"] = parsed
+    return item
+
+def attachments_to_bytes(data):
+    """Chuyển ảnh/file base64 trong payload (và history) sang bytes trước khi gửi binary"""
+    data = _to_raw(data)
+    if isinstance(data, dict) and isinstance(data.get("history"), list):
+        data = dict(data)
+        data["history"] = [_to_raw(item) for item in data["history"]]
+    return data
+
+class JsonCodec:
+    """Mặc định: JSON trên text frame"""
+    name = "json"
+    subprotocol = "chat.json"
+
+    def encode(self, data):
+        return json.dumps(data)
+
+    def decode(self, raw):
+        return json.loads(raw)
+
+    def join(self, frames):
+        """Gộp các frame đã encode thành 1 array"""
+        return "[" + ",".join(frames) + "]"
+
+class MsgpackCodec:
+    """MessagePack trên binary frame, attachment là bytes"""
+    name = "msgpack"
+    subprotocol = "chat.msgpack"
+
+    def encode(self, data):
+        return msgpack.packb(attachments_to_bytes(data), use_bin_type=True)
+
+    def decode(self, raw):
+        # attachment (bytes) giữ nguyên, server ghi thẳng vào blob store
+        return msgpack.unpackb(raw, raw=False)
+
+    def join(self, frames):
+        n = len(frames)
+        if n < 16:
+            header = bytes([0x90 | n])
+        elif n < 0x10000:
+            header = b"\xdc" + n.to_bytes(2, "big")
+        else:
+            header = b"\xdd" + n.to_bytes(4, "big")
+        return header + b"".join(frames)
+
+class CborCodec:
+    """CBOR trên binary frame, attachment là bytes"""
+    name = "cbor"
+    subprotocol = "chat.cbor"
+
+    def encode(self, data):
+        return cbor2.dumps(attachments_to_bytes(data))
+
+    def decode(self, raw):
+        return cbor2.loads(raw)
+
+    def join(self, frames):
+        n = len(frames)
+        if n < 24:
+            header = bytes([0x80 | n])
+        elif n < 0x100:
+            header = b"\x98" + bytes([n])
+        elif n < 0x10000:
+            header = b"\x99" + n.to_bytes(2, "big")
+        else:
+            header = b"\x9a" + n.to_bytes(4, "big")
+        return header + b"".join(frames)
+
+JSON = JsonCodec()
+
+# Thứ tự ưu tiên khi thương lượng subprotocol (chỉ gồm codec có thư viện)
+CODECS = [JSON]
+if msgpack is not None:
+    CODECS.insert(0, MsgpackCodec())
+if cbor2 is not None:
+    CODECS.insert(-1, CborCodec())
+
+SUBPROTOCOLS = [codec.subprotocol for codec in CODECS]
+
+def codec_for(subprotocol):
+    """Codec theo subprotocol đã thương lượng, mặc định JSON"""
+    for codec in CODECS:
+        if codec.subprotocol == subprotocol:
+            return codec
+    return JSON
@@ -1,165 +1,487 @@
-import sqlite3
-import bcrypt
-from datetime import datetime
-
-# Kết nối database
-conn = sqlite3.connect("chat.db", check_same_thread=False)
-cur = conn.cursor()
-
-def init_db():
-    """Khởi tạo database"""
-    # Bảng users
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        username TEXT UNIQUE NOT NULL,
-        password TEXT NOT NULL,
-        role TEXT DEFAULT 'user',
-        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-    )
-    """)
-    
-    # Bảng messages
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS messages (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        room TEXT NOT NULL,
-        sender TEXT NOT NULL,
-        message TEXT NOT NULL,
-        msg_type TEXT DEFAULT 'text',
-        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-    )
-    """)
-    
-    # Bảng private_messages
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS private_messages (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        sender TEXT NOT NULL,
-        receiver TEXT NOT NULL,
-        message TEXT NOT NULL,
-        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-    )
-    """)
-    
-    # Tạo admin mặc định nếu chưa có
-    if not user_exists("admin"):
-        hashed = hash_password("admin123")
-        cur.execute(
-            "INSERT INTO users (username, password, role) VALUES (?, ?, ?)",
-            ("admin", hashed, "admin")
-        )
-    
-    conn.commit()
-    print("✅ Database initialized")
-
-def hash_password(password):
-    """Hash password với bcrypt"""
-    salt = bcrypt.gensalt()
-    return bcrypt.hashpw(password.encode('utf-8'), salt).decode('utf-8')
-
-def verify_password(password, hashed):
-    """Kiểm tra password"""
-    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
-
-def user_exists(username):
-    """Kiểm tra user đã tồn tại chưa"""
-    cur.execute("SELECT 1 FROM users WHERE username=?", (username,))
-    return cur.fetchone() is not None
-
-def create_user(username, password):
-    """Tạo user mới"""
-    hashed = hash_password(password)
-    cur.execute(
-        "INSERT INTO users (username, password) VALUES (?, ?)",
-        (username, hashed)
-    )
-    conn.commit()
-    return True
-
-def verify_user(username, password):
-    """Xác thực user"""
-    cur.execute("SELECT password FROM users WHERE username=?", (username,))
-    row = cur.fetchone()
-    if row:
-        return verify_password(password, row[0])
-    return False
-
-def get_user_role(username):
-    """Lấy role của user"""
-    cur.execute("SELECT role FROM users WHERE username=?", (username,))
-    row = cur.fetchone()
-    return row[0] if row else "user"
-
-def save_message(room, sender, message, msg_type="text"):
-    """Lưu tin nhắn"""
-    cur.execute(
-        "INSERT INTO messages (room, sender, message, msg_type) VALUES (?, ?, ?, ?)",
-        (room, sender, message, msg_type)
-    )
-    conn.commit()
-    return cur.lastrowid
-
-def save_private_message(sender, receiver, message):
-    """Lưu tin nhắn riêng"""
-    cur.execute(
-        "INSERT INTO private_messages (sender, receiver, message) VALUES (?, ?, ?)",
-        (sender, receiver, message)
-    )
-    conn.commit()
-
-def load_messages(room, limit=100):
-    """Tải tin nhắn của room"""
-    cur.execute(
-        """SELECT sender, message, msg_type, 
-           strftime('%H:%M', created_at) as time 
-           FROM messages 
-           WHERE room=? 
-           ORDER BY id DESC LIMIT ?""",
-        (room, limit)
-    )
-    rows = cur.fetchall()
-    return [
-        {
-            "sender": r[0], 
-            "message": r[1], 
-            "type": r[2],
-            "time": r[3]
-        } 
-        for r in reversed(rows)
-    ]
-
-def load_private_messages(user1, user2, limit=50):
-    """Tải tin nhắn riêng giữa 2 user"""
-    cur.execute(
-        """SELECT sender, receiver, message, 
-           strftime('%H:%M', created_at) as time 
-           FROM private_messages 
-           WHERE (sender=? AND receiver=?) OR (sender=? AND receiver=?)
-           ORDER BY id DESC LIMIT ?""",
-        (user1, user2, user2, user1, limit)
-    )
-    rows = cur.fetchall()
-    return [
-        {
-            "sender": r[0],
-            "receiver": r[1],
-            "message": r[2],
-            "time": r[3]
-        }
-        for r in reversed(rows)
-    ]
-
-def get_all_users():
-    """Lấy danh sách tất cả users"""
-    cur.execute("SELECT username, role FROM users ORDER BY username")
-    return cur.fetchall()
-
-def delete_message(msg_id):
-    """Xóa tin nhắn (cho admin)"""
-    cur.execute("DELETE FROM messages WHERE id=?", (msg_id,))
-    conn.commit()
-    return cur.rowcount > 0
-
-# Khởi tạo database khi import
-init_db()
\ No newline at end of file
+import asyncio
+import os
+import queue
+import sqlite3
+import threading
+import time
+import bcrypt
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from migrations import migrate
+
+# Kết nối database (CHAT_DB: đổi file, vd. DB tạm cho test / benchmark)
+DB_PATH = os.environ.get("CHAT_DB", "chat.db")
+conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+cur = conn.cursor()
+
+def reconnect():
+    """Mở kết nối mới (worker gọi sau khi fork, không dùng lại conn của process cha)"""
+    global conn, cur
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    cur = conn.cursor()
+
+def close():
+    """Đóng kết nối (process cha gọi trước khi fork worker)"""
+    conn.close()
+
+def init_db():
+    """Khởi tạo database"""
+    # WAL: reader không chặn writer và ngược lại (lưu luôn trong file chat.db)
+    cur.execute("PRAGMA journal_mode=WAL")
+    
+    # Bảng users
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE NOT NULL,
+        password TEXT NOT NULL,
+        role TEXT DEFAULT 'user',
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    
+    # Bảng messages
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        room TEXT NOT NULL,
+        sender TEXT NOT NULL,
+        message TEXT NOT NULL,
+        msg_type TEXT DEFAULT 'text',
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    
+    # Bảng private_messages
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS private_messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        sender TEXT NOT NULL,
+        receiver TEXT NOT NULL,
+        message TEXT NOT NULL,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    
+    # Bảng blobs: metadata file đính kèm (nội dung nằm trong blob store, khóa = sha256)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS blobs (
+        hash TEXT PRIMARY KEY,
+        mime TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    
+    # Bảng blob_variants: ảnh thu nhỏ (thumb / display) của ảnh gốc
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS blob_variants (
+        hash TEXT NOT NULL,
+        variant TEXT NOT NULL,
+        variant_hash TEXT NOT NULL,
+        PRIMARY KEY (hash, variant)
+    )
+    """)
+    
+    # Tạo admin mặc định nếu chưa có
+    if not user_exists("admin"):
+        hashed = hash_password("admin123")
+        cur.execute(
+            "INSERT INTO users (username, password, role) VALUES (?, ?, ?)",
+            ("admin", hashed, "admin")
+        )
+    
+    conn.commit()
+    
+    # Nâng cấp schema (cột mới, index, điền dữ liệu cũ) theo version
+    migrate(conn)
+    print("✅ Database initialized")
+
+def hash_password(password):
+    """Hash password với bcrypt"""
+    salt = bcrypt.gensalt()
+    return bcrypt.hashpw(password.encode('utf-8'), salt).decode('utf-8')
+
+def verify_password(password, hashed):
+    """Kiểm tra password"""
+    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+
+def user_exists(username):
+    """Kiểm tra user đã tồn tại chưa"""
+    c = _cursor()
+    c.execute("SELECT 1 FROM users WHERE username=?", (username,))
+    return c.fetchone() is not None
+
+def queue_user(username, hashed):
+    """Thêm user qua writer, Future lỗi nếu username đã tồn tại"""
+    return _queue_insert(
+        "INSERT INTO users (username, password) VALUES (?, ?)",
+        (username, hashed)
+    )
+
+def insert_user(username, hashed):
+    """Thêm user với password đã hash"""
+    queue_user(username, hashed).result()
+    return True
+
+def get_password_hash(username):
+    """Lấy password đã hash của user (None nếu không có)"""
+    c = _cursor()
+    c.execute("SELECT password FROM users WHERE username=?", (username,))
+    row = c.fetchone()
+    return row[0] if row else None
+
+def create_user(username, password):
+    """Tạo user mới"""
+    return insert_user(username, hash_password(password))
+
+def verify_user(username, password):
+    """Xác thực user"""
+    hashed = get_password_hash(username)
+    if hashed:
+        return verify_password(password, hashed)
+    return False
+
+def get_user_role(username):
+    """Lấy role của user"""
+    c = _cursor()
+    c.execute("SELECT role FROM users WHERE username=?", (username,))
+    row = c.fetchone()
+    return row[0] if row else "user"
+
+def queue_user_role(username, role):
+    """Đổi role qua writer, Future trả về số dòng đã đổi"""
+    return _queue_write("UPDATE users SET role=? WHERE username=?", (role, username))
+
+def set_user_role(username, role):
+    """Đổi role của user (admin)"""
+    return queue_user_role(username, role).result() > 0
+
+def save_message(room, sender, message, msg_type="text"):
+    """Lưu tin nhắn"""
+    return queue_message(room, sender, message, msg_type).result()
+
+def conversation_key(user1, user2):
+    """Khóa hội thoại riêng, giống nhau cho cả 2 chiều (xem migrations.CONVERSATION_SQL)"""
+    return "\x1f".join(sorted((user1, user2)))
+
+def save_private_message(sender, receiver, message):
+    """Lưu tin nhắn riêng"""
+    queue_private_message(sender, receiver, message).result()
+
+# ========= GHI SAU THEO LÔ (write-behind + group commit) =========
+PERSIST_BATCH_SIZE = int(os.environ.get("PERSIST_BATCH_SIZE", "200"))   # số dòng tối đa / commit
+PERSIST_BATCH_MS = float(os.environ.get("PERSIST_BATCH_MS", "5"))       # thời gian gom tối đa / commit
+PERSIST_SYNCHRONOUS = os.environ.get("PERSIST_SYNCHRONOUS", "NORMAL")   # FULL | NORMAL | OFF
+
+class WriteBehind:
+    """Thread ghi riêng: gom các INSERT trong hàng đợi rồi commit 1 lần"""
+
+    def __init__(self, path=DB_PATH):
+        self.path = path
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, sql, params, rowcount=False):
+        """Đưa 1 câu ghi vào hàng đợi, Future trả về id dòng (hoặc số dòng bị đổi) sau khi commit"""
+        future = Future()
+        self.queue.put((future, sql, params, rowcount))
+        return future
+
+    def stop(self):
+        """Ghi nốt hàng đợi rồi dừng thread"""
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        wconn = sqlite3.connect(self.path)
+        wconn.execute(f"PRAGMA synchronous={PERSIST_SYNCHRONOUS}")
+        wcur = wconn.cursor()
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + PERSIST_BATCH_MS / 1000
+            while batch[-1] is not None and len(batch) < PERSIST_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                batch.pop()
+                running = False
+
+            done = []
+            for future, sql, params, rowcount in batch:
+                try:
+                    wcur.execute(sql, params)
+                    done.append((future, wcur.rowcount if rowcount else wcur.lastrowid))
+                except Exception as e:
+                    # Lỗi của 1 câu (vd. chuỗi không encode được) chỉ báo cho câu đó, thread ghi vẫn chạy tiếp
+                    future.set_exception(e)
+            try:
+                wconn.commit()
+            except Exception as e:
+                # Bỏ cả lô: không để lần commit sau ghi các dòng đã báo lỗi cho người gọi
+                try:
+                    wconn.rollback()
+                except sqlite3.Error:
+                    pass
+                for future, _ in done:
+                    future.set_exception(e)
+                continue
+            for future, row_id in done:
+                future.set_result(row_id)
+        wconn.close()
+
+writer = None
+
+def start_writer():
+    """Bật ghi theo lô (gọi trong process sẽ ghi, sau khi fork)"""
+    global writer
+    writer = WriteBehind()
+    writer.start()
+
+def stop_writer():
+    """Flush hàng đợi khi tắt server"""
+    global writer
+    if writer:
+        writer.stop()
+        writer = None
+
+def _queue_insert(sql, params):
+    """INSERT qua writer nếu đã bật, không thì ghi ngay"""
+    if writer:
+        return writer.submit(sql, params)
+    future = Future()
+    cur.execute(sql, params)
+    conn.commit()
+    future.set_result(cur.lastrowid)
+    return future
+
+def _queue_write(sql, params):
+    """UPDATE / DELETE qua writer (chỉ 1 connection ghi), Future trả về số dòng bị đổi"""
+    if writer:
+        return writer.submit(sql, params, rowcount=True)
+    future = Future()
+    cur.execute(sql, params)
+    conn.commit()
+    future.set_result(cur.rowcount)
+    return future
+
+# ========= ĐỌC SONG SONG (WAL + pool connection chỉ đọc) =========
+READ_POOL_SIZE = int(os.environ.get("READ_POOL_SIZE", "4"))
+
+_local = threading.local()   # cursor của reader đang chạy trong thread hiện tại
+
+def _cursor():
+    """Cursor để đọc: của reader pool nếu đang ở thread đọc, không thì cursor chung"""
+    return getattr(_local, "cur", None) or cur
+
+class ReaderPool:
+    """Các connection chỉ đọc, query chạy ở thread riêng nên không chặn event loop hay writer"""
+
+    def __init__(self, path=DB_PATH, size=READ_POOL_SIZE):
+        self.size = size
+        self.idle = queue.Queue()
+        for _ in range(size):
+            self.idle.put(sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False))
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="db-reader")
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.count = 0
+        self.wait_ms = 0.0
+        self.run_ms = 0.0
+        self.max_wait_ms = 0.0
+
+    def _call(self, submitted, fn, args):
+        rconn = self.idle.get()
+        started = time.perf_counter()
+        _local.cur = rconn.cursor()
+        try:
+            return fn(*args)
+        finally:
+            _local.cur = None
+            self.idle.put(rconn)
+            with self.lock:
+                self.count += 1
+                self.wait_ms += (started - submitted) * 1000
+                self.run_ms += (time.perf_counter() - started) * 1000
+                self.max_wait_ms = max(self.max_wait_ms, (started - submitted) * 1000)
+
+    async def run(self, fn, *args):
+        """Chạy hàm đọc fn(*args) trên 1 connection của pool"""
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, self._call, time.perf_counter(), fn, args
+            )
+        finally:
+            self.pending -= 1
+
+    def close(self):
+        self.executor.shutdown()
+        while not self.idle.empty():
+            self.idle.get().close()
+
+    def stats(self):
+        """Thời gian chờ connection / chạy query trung bình"""
+        return {
+            "size": self.size,
+            "pending": self.pending,
+            "count": self.count,
+            "avg_wait_ms": round(self.wait_ms / self.count, 3) if self.count else 0.0,
+            "max_wait_ms": round(self.max_wait_ms, 3),
+            "avg_run_ms": round(self.run_ms / self.count, 3) if self.count else 0.0
+        }
+
+readers = None
+
+def start_readers():
+    """Mở reader pool (gọi trong process sẽ đọc, sau khi fork)"""
+    global readers
+    readers = ReaderPool()
+
+def stop_readers():
+    global readers
+    if readers:
+        readers.close()
+        readers = None
+
+async def read(fn, *args):
+    """Chạy hàm đọc trên reader pool nếu đã bật, không thì chạy luôn"""
+    if readers:
+        return await readers.run(fn, *args)
+    return fn(*args)
+
+def queue_message(room, sender, message, msg_type="text"):
+    """Lưu tin nhắn qua hàng đợi, Future trả về id tin nhắn"""
+    return _queue_insert(
+        "INSERT INTO messages (room, sender, message, msg_type) VALUES (?, ?, ?, ?)",
+        (room, sender, message, msg_type)
+    )
+
+def queue_private_message(sender, receiver, message):
+    """Lưu tin nhắn riêng qua hàng đợi"""
+    return _queue_insert(
+        "INSERT INTO private_messages (sender, receiver, message, conversation) VALUES (?, ?, ?, ?)",
+        (sender, receiver, message, conversation_key(sender, receiver))
+    )
+
+def queue_blob_meta(digest, mime, size):
+    """Lưu metadata blob qua hàng đợi (trùng hash thì bỏ qua)"""
+    return _queue_insert(
+        "INSERT OR IGNORE INTO blobs (hash, mime, size) VALUES (?, ?, ?)",
+        (digest, mime, size)
+    )
+
+def get_blob_meta(digest):
+    """Metadata của blob, None nếu không có"""
+    c = _cursor()
+    c.execute("SELECT mime, size FROM blobs WHERE hash=?", (digest,))
+    row = c.fetchone()
+    return {"mime": row[0], "size": row[1]} if row else None
+
+def queue_blob_variant(digest, variant, variant_hash):
+    """Ghi nhận bản thu nhỏ của ảnh qua hàng đợi"""
+    return _queue_insert(
+        "INSERT OR REPLACE INTO blob_variants (hash, variant, variant_hash) VALUES (?, ?, ?)",
+        (digest, variant, variant_hash)
+    )
+
+def get_blob_variant(digest, variant):
+    """Hash của bản thu nhỏ, None nếu chưa có (ảnh nhỏ hoặc chưa xử lý)"""
+    c = _cursor()
+    c.execute("SELECT variant_hash FROM blob_variants WHERE hash=? AND variant=?", (digest, variant))
+    row = c.fetchone()
+    return row[0] if row else None
+
+def load_messages(room, limit=100, before_id=None):
+    """Tải tin nhắn của room (before_id: chỉ lấy tin cũ hơn id này - phân trang keyset)"""
+    c = _cursor()
+    if before_id is None:
+        c.execute(
+            """SELECT id, sender, message, msg_type, 
+               strftime('%H:%M', created_at) as time 
+               FROM messages 
+               WHERE room=? 
+               ORDER BY id DESC LIMIT ?""",
+            (room, limit)
+        )
+    else:
+        c.execute(
+            """SELECT id, sender, message, msg_type, 
+               strftime('%H:%M', created_at) as time 
+               FROM messages 
+               WHERE room=? AND id<? 
+               ORDER BY id DESC LIMIT ?""",
+            (room, before_id, limit)
+        )
+    rows = c.fetchall()
+    return [
+        {
+            "id": r[0],
+            "sender": r[1], 
+            "message": r[2], 
+            "type": r[3],
+            "time": r[4]
+        } 
+        for r in reversed(rows)
+    ]
+
+def load_messages_since(room, since_id, limit=100):
+    """Tải tin nhắn của room có id > since_id (đồng bộ khi kết nối lại)"""
+    c = _cursor()
+    c.execute(
+        """SELECT id, sender, message, msg_type, 
+           strftime('%H:%M', created_at) as time 
+           FROM messages 
+           WHERE room=? AND id>? 
+           ORDER BY id LIMIT ?""",
+        (room, since_id, limit)
+    )
+    return [
+        {
+            "id": r[0],
+            "sender": r[1], 
+            "message": r[2], 
+            "type": r[3],
+            "time": r[4]
+        } 
+        for r in c.fetchall()
+    ]
+
+def load_private_messages(user1, user2, limit=50):
+    """Tải tin nhắn riêng giữa 2 user"""
+    c = _cursor()
+    c.execute(
+        """SELECT sender, receiver, message, 
+           strftime('%H:%M', created_at) as time 
+           FROM private_messages 
+           WHERE conversation=? 
+           ORDER BY id DESC LIMIT ?""",
+        (conversation_key(user1, user2), limit)
+    )
+    rows = c.fetchall()
+    return [
+        {
+            "sender": r[0],
+            "receiver": r[1],
+            "message": r[2],
+            "time": r[3]
+        }
+        for r in reversed(rows)
+    ]
+
+def get_all_users():
+    """Lấy danh sách tất cả users"""
+    c = _cursor()
+    c.execute("SELECT username, role FROM users ORDER BY username")
+    return c.fetchall()
+
+def delete_message(msg_id):
+    """Xóa tin nhắn (cho admin)"""
+    return _queue_write("DELETE FROM messages WHERE id=?", (msg_id,)).result() > 0
@@ -0,0 +1,60 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Pool riêng cho bcrypt (mỗi lần hash/verify tốn ~100-300 ms CPU)
+HASH_WORKERS = int(os.environ.get("HASH_WORKERS", "4"))        # số bcrypt chạy song song
+HASH_MAX_QUEUE = int(os.environ.get("HASH_MAX_QUEUE", "32"))   # số yêu cầu được chờ thêm
+
+class PoolBusy(Exception):
+    """Pool đã đầy, client nên thử lại sau"""
+
+class HashPool:
+    """Chạy bcrypt trên thread pool có giới hạn, không chặn event loop"""
+
+    def __init__(self, workers=HASH_WORKERS, max_queue=HASH_MAX_QUEUE):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self.pending = 0
+        self.rejected = 0
+        self.count = 0
+        self.wait_ms = 0.0
+        self.run_ms = 0.0
+        self.max_total_ms = 0.0
+
+    async def run(self, fn, *args):
+        """Chạy fn(*args) trên pool, raise PoolBusy nếu hàng đợi đã đầy"""
+        if self.pending >= self.workers + self.max_queue:
+            self.rejected += 1
+            raise PoolBusy()
+
+        self.pending += 1
+        submitted = time.perf_counter()
+
+        def job():
+            started = time.perf_counter()
+            return fn(*args), started, time.perf_counter()
+
+        try:
+            result, started, finished = await asyncio.get_running_loop().run_in_executor(self.executor, job)
+        finally:
+            self.pending -= 1
+
+        self.count += 1
+        self.wait_ms += (started - submitted) * 1000
+        self.run_ms += (finished - started) * 1000
+        self.max_total_ms = max(self.max_total_ms, (finished - submitted) * 1000)
+        return result
+
+    def stats(self):
+        """Độ trễ chờ / chạy trung bình của pool"""
+        return {
+            "pending": self.pending,
+            "rejected": self.rejected,
+            "count": self.count,
+            "avg_wait_ms": round(self.wait_ms / self.count, 3) if self.count else 0.0,
+            "avg_run_ms": round(self.run_ms / self.count, 3) if self.count else 0.0,
+            "max_total_ms": round(self.max_total_ms, 3)
+        }
@@ -0,0 +1,123 @@
+import os
+from collections import OrderedDict, deque
+
+# Cache lịch sử trong RAM: N tin nhắn gần nhất mỗi room
+HISTORY_SIZE = int(os.environ.get("HISTORY_SIZE", "100"))
+HISTORY_BUDGET = int(os.environ.get("HISTORY_BUDGET", str(64 * 1024 * 1024)))  # byte (ước lượng)
+
+def item_size(item):
+    """Ước lượng bộ nhớ của 1 tin nhắn trong cache"""
+    return 64 + sum(len(v) for v in item.values() if isinstance(v, str))
+
+class HistoryCache:
+    """Ring buffer lịch sử mỗi room, nạp lười từ DB, bỏ room ít dùng (LRU) khi vượt ngân sách"""
+
+    def __init__(self, loader, size=HISTORY_SIZE, budget=HISTORY_BUDGET):
+        self.loader = loader          # loader(room, limit) -> list tin nhắn cũ -> mới, None = chỉ nạp qua begin/finish_load
+        self.size = size
+        self.budget = budget
+        self.rooms = OrderedDict()    # room -> deque(maxlen=size), cuối = dùng gần nhất
+        self.loading = {}             # room đang nạp ở thread khác -> tin nhắn mới đến trong lúc đó
+        self.room_bytes = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, room):
+        """N tin nhắn gần nhất của room (cũ -> mới)"""
+        buf = self.rooms.get(room)
+        if buf is not None:
+            self.hits += 1
+            self.rooms.move_to_end(room)
+            return list(buf)
+
+        self.misses += 1
+        self._store(room, self.loader(room, self.size))
+        return list(self.rooms[room])
+
+    def loaded(self, room):
+        return room in self.rooms
+
+    def begin_load(self, room):
+        """Bắt đầu nạp room từ DB ở thread khác (tin nhắn đến trong lúc đó được giữ lại)"""
+        self.misses += 1
+        self.loading.setdefault(room, [])
+
+    def finish_load(self, room, items):
+        """Nạp kết quả đọc DB + các tin nhắn mới hơn đến trong lúc đọc"""
+        arrived = self.loading.pop(room, [])
+        if room in self.rooms:
+            return
+        last_id = items[-1]["id"] if items else 0
+        self._store(room, list(items) + [item for item in arrived if item["id"] > last_id])
+
+    def cancel_load(self, room):
+        self.loading.pop(room, None)
+
+    def _store(self, room, items):
+        buf = deque(items, maxlen=self.size)
+        self.rooms[room] = buf
+        self.room_bytes[room] = sum(item_size(item) for item in buf)
+        self.total_bytes += self.room_bytes[room]
+        self._evict(keep=room)
+
+    def append(self, room, item):
+        """Thêm tin nhắn mới (gọi từ luồng ghi). Room chưa nạp thì bỏ qua, lần đọc sau sẽ lấy từ DB"""
+        buf = self.rooms.get(room)
+        if buf is None:
+            if room in self.loading:
+                self.loading[room].append(item)
+            return
+        if buf and item["id"] <= buf[-1]["id"] and any(old["id"] == item["id"] for old in buf):
+            return  # đã có (bản đọc DB xong trước khi tin này kịp vào cache)
+        delta = item_size(item)
+        if len(buf) == buf.maxlen:
+            delta -= item_size(buf[0])
+        buf.append(item)
+        self.room_bytes[room] += delta
+        self.total_bytes += delta
+        self.rooms.move_to_end(room)
+        self._evict(keep=room)
+
+    def since(self, room, since_id):
+        """Các tin nhắn có id > since_id nếu cache chắc chắn có đủ, không thì None"""
+        self.get(room)
+        buf = self.rooms[room]
+        if buf and buf[0]["id"] > since_id and len(buf) == buf.maxlen:
+            return None  # có thể đã mất tin giữa since_id và tin cũ nhất trong cache
+        return [item for item in buf if item["id"] > since_id]
+
+    def page(self, room, before_id, limit):
+        """Trang tin nhắn có id < before_id nếu cache đủ dữ liệu, không thì None"""
+        buf = self.rooms.get(room)
+        if not buf or buf[0]["id"] >= before_id:
+            return None
+        older = [item for item in buf if item["id"] < before_id]
+        if len(older) < limit and len(buf) == buf.maxlen:
+            return None  # phần còn lại nằm trong DB
+        self.hits += 1
+        return older[-limit:]
+
+    def invalidate(self, room):
+        """Bỏ cache của room (vd: admin xóa tin nhắn)"""
+        if self.rooms.pop(room, None) is not None:
+            self.total_bytes -= self.room_bytes.pop(room)
+
+    def _evict(self, keep):
+        while self.total_bytes > self.budget and len(self.rooms) > 1:
+            room = next(iter(self.rooms))
+            if room == keep:
+                self.rooms.move_to_end(room)
+                continue
+            self.invalidate(room)
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            "rooms": len(self.rooms),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
@@ -0,0 +1,111 @@
+import asyncio
+import io
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from blobstore import blob_path, put_blob
+
+# Pillow là tùy chọn: thiếu thì chỉ gửi ảnh gốc
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", "2"))   # số process giải mã/thu nhỏ ảnh
+VARIANT_SIZES = {"thumb": 320, "display": 1280}             # cạnh dài tối đa (px)
+VARIANT_QUALITY = int(os.environ.get("VARIANT_QUALITY", "80"))
+
+def render_variants(path):
+    """Chạy trong process con: đọc ảnh gốc, trả về {tên: (bytes, mime)} cho các cỡ nhỏ hơn ảnh gốc"""
+    variants = {}
+    with Image.open(path) as img:
+        # JPEG: giải mã thẳng ở độ phân giải thấp hơn (nhanh hơn nhiều so với giải mã full rồi thu nhỏ)
+        biggest = max(VARIANT_SIZES.values())
+        img.draft("RGB", (biggest, biggest))
+        img = ImageOps.exif_transpose(img)  # ảnh điện thoại: xoay theo EXIF
+        alpha = img.mode in ("RGBA", "LA", "P")
+        for name, edge in sorted(VARIANT_SIZES.items(), key=lambda item: -item[1]):
+            if max(img.size) <= edge:
+                continue
+            img.thumbnail((edge, edge))
+            out = io.BytesIO()
+            if alpha:
+                img.save(out, "PNG", optimize=True)
+                variants[name] = (out.getvalue(), "image/png")
+            else:
+                img.convert("RGB").save(out, "JPEG", quality=VARIANT_QUALITY, optimize=True)
+                variants[name] = (out.getvalue(), "image/jpeg")
+    return variants
+
+class ImagePool:
+    """Tạo thumbnail + bản hiển thị cho ảnh upload trên process pool (không chặn event loop)"""
+
+    def __init__(self, store, workers=IMAGE_WORKERS):
+        self.store = store                # repository lưu metadata của bản thu nhỏ
+        self.workers = workers
+        self.executor = None
+        self.pending = {}                 # hash gốc -> task đang xử lý
+        self.count = 0
+        self.failed = 0
+        self.run_ms = 0.0
+
+    @property
+    def enabled(self):
+        return Image is not None and self.workers > 0
+
+    def start(self):
+        """Tạo process pool (gọi trước khi bật các thread khác để fork an toàn)"""
+        if not self.enabled:
+            return
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("fork" if "fork" in methods else None)
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+        self.executor.submit(int).result()  # khởi động process ngay
+
+    def stop(self):
+        if self.executor:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+    def schedule(self, digest, mime):
+        """Đưa ảnh vừa lưu vào hàng đợi xử lý"""
+        if not self.executor or not mime.startswith("image/") or digest in self.pending:
+            return
+        task = asyncio.ensure_future(self._process(digest))
+        self.pending[digest] = task
+        task.add_done_callback(lambda _: self.pending.pop(digest, None))
+
+    async def wait(self, digest):
+        """Chờ ảnh đang xử lý xong (nếu có) trước khi chọn bản gửi cho client"""
+        task = self.pending.get(digest)
+        if task:
+            await asyncio.shield(task)
+
+    async def _process(self, digest):
+        started = time.perf_counter()
+        try:
+            variants = await asyncio.get_running_loop().run_in_executor(
+                self.executor, render_variants, blob_path(digest)
+            )
+            for name, (data, mime) in variants.items():
+                variant_digest = await asyncio.to_thread(put_blob, data)
+                await self.store.save_blob_meta(variant_digest, mime, len(data))
+                # Chờ ghi xong để client hỏi ngay sau đó thấy được bản thu nhỏ
+                await self.store.save_blob_variant(digest, name, variant_digest)
+        except Exception as e:
+            self.failed += 1
+            print(f"⚠️ Không tạo được ảnh thu nhỏ cho {digest[:12]}: {e}")
+            return
+        self.count += 1
+        self.run_ms += (time.perf_counter() - started) * 1000
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "pending": len(self.pending),
+            "count": self.count,
+            "failed": self.failed,
+            "avg_ms": round(self.run_ms / self.count, 3) if self.count else 0.0
+        }
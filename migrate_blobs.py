@@ -0,0 +1,47 @@
+"""Chuyển ảnh/file base64 cũ trong chat.db sang blob store (chạy lại nhiều lần không sao)"""
+import db
+from blobstore import split_inline_attachment, store_attachment
+
+BATCH_SIZE = 200
+
+def migrate_table(table, with_type):
+    """Duyệt bảng theo id từng lô, thay data URL bằng tham chiếu blob"""
+    last_id = 0
+    moved = 0
+    while True:
+        db.cur.execute(
+            f"""SELECT id, message FROM {table}
+                WHERE id>? AND (message LIKE 'data:%' OR message LIKE 'FILE|%')
+                ORDER BY id LIMIT ?""",
+            (last_id, BATCH_SIZE)
+        )
+        rows = db.cur.fetchall()
+        if not rows:
+            return moved
+
+        for row_id, message in rows:
+            inline = split_inline_attachment(message)
+            if inline is None:
+                continue
+            data, mime, name = inline
+            ref, msg_type, digest = store_attachment(data, mime, name)
+            db.cur.execute(
+                "INSERT OR IGNORE INTO blobs (hash, mime, size) VALUES (?, ?, ?)",
+                (digest, mime, len(data))
+            )
+            if with_type:
+                db.cur.execute("UPDATE messages SET message=?, msg_type=? WHERE id=?", (ref, msg_type, row_id))
+            else:
+                db.cur.execute(f"UPDATE {table} SET message=? WHERE id=?", (ref, row_id))
+            moved += 1
+
+        # Commit theo lô để không giữ khóa DB lâu
+        db.conn.commit()
+        last_id = rows[-1][0]
+
+if __name__ == "__main__":
+    db.init_db()
+    print(f"messages: {migrate_table('messages', True)} file đã chuyển")
+    print(f"private_messages: {migrate_table('private_messages', False)} file đã chuyển")
+    db.cur.execute("VACUUM")
+    print("✅ Xong")
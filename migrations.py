@@ -0,0 +1,73 @@
+import os
+import time
+
+# Migration theo version (PRAGMA user_version): mỗi bước chạy 1 lần, chạy lại không sao
+BACKFILL_BATCH = int(os.environ.get("BACKFILL_BATCH", "1000"))       # số dòng / lô
+BACKFILL_PAUSE_MS = float(os.environ.get("BACKFILL_PAUSE_MS", "10"))  # nghỉ giữa 2 lô cho connection khác ghi
+
+# Khóa hội thoại: 2 username sắp xếp tăng dần, nối bằng ký tự 0x1F (không xuất hiện trong username)
+CONVERSATION_SQL = "CASE WHEN sender < receiver THEN sender || char(31) || receiver ELSE receiver || char(31) || sender END"
+
+def has_column(conn, table, column):
+    return any(row[1] == column for row in conn.execute(f"PRAGMA table_info({table})"))
+
+def backfill(conn, table, assignment, where):
+    """UPDATE theo từng lô nhỏ, commit sau mỗi lô để không giữ khóa ghi của chat.db lâu"""
+    # Keyset theo id: mỗi lô đi tiếp từ last_id, không quét lại phần đầu bảng đã điền xong
+    total, last_id = 0, 0
+    while True:
+        ids = [row[0] for row in conn.execute(
+            f"SELECT id FROM {table} WHERE id > ? AND ({where}) ORDER BY id LIMIT ?",
+            (last_id, BACKFILL_BATCH)
+        )]
+        if not ids:
+            return total
+        total += conn.execute(
+            f"UPDATE {table} SET {assignment} WHERE id BETWEEN ? AND ? AND ({where})",
+            (ids[0], ids[-1])
+        ).rowcount
+        conn.commit()
+        last_id = ids[-1]
+        if len(ids) < BACKFILL_BATCH:
+            return total
+        time.sleep(BACKFILL_PAUSE_MS / 1000)
+
+def add_conversation_key(conn):
+    """private_messages.conversation: khóa chung cho cả 2 chiều của 1 cuộc chat riêng"""
+    if not has_column(conn, "private_messages", "conversation"):
+        conn.execute("ALTER TABLE private_messages ADD COLUMN conversation TEXT")
+        conn.commit()
+
+def backfill_conversation_key(conn):
+    """Điền conversation cho tin nhắn riêng cũ (dừng giữa chừng thì lần sau làm tiếp)"""
+    count = backfill(conn, "private_messages", f"conversation = {CONVERSATION_SQL}", "conversation IS NULL")
+    if count:
+        print(f"   đã điền conversation cho {count} tin nhắn riêng")
+
+def add_history_indexes(conn):
+    """Index (room, id) và (conversation, id): tải lịch sử / phân trang không phải quét cả bảng"""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_room_id ON messages (room, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_private_conversation_id ON private_messages (conversation, id)")
+    conn.commit()
+
+MIGRATIONS = [
+    (1, add_conversation_key),
+    (2, backfill_conversation_key),
+    (3, add_history_indexes),
+]
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(conn):
+    """Chạy các migration chưa áp dụng theo thứ tự version"""
+    current = schema_version(conn)
+    for version, step in MIGRATIONS:
+        if version <= current:
+            continue
+        started = time.perf_counter()
+        step(conn)
+        conn.execute(f"PRAGMA user_version = {version}")
+        conn.commit()
+        print(f"🛠️ Migration {version} ({step.__name__}): {(time.perf_counter() - started) * 1000:.0f} ms")
+    return schema_version(conn)
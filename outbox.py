@@ -0,0 +1,137 @@
+import asyncio
+import os
+import time
+from collections import deque
+
+from codec import JSON
+
+# Cấu hình hàng đợi gửi (có thể chỉnh qua biến môi trường)
+OUTBOX_SIZE = int(os.environ.get("OUTBOX_SIZE", "256"))             # số frame tối đa chờ gửi
+OUTBOX_POLICY = os.environ.get("OUTBOX_POLICY", "collapse")         # drop_oldest | collapse | disconnect
+OUTBOX_LAG_LIMIT = float(os.environ.get("OUTBOX_LAG_LIMIT", "10"))  # giây, dùng cho policy disconnect
+
+POLICIES = ("drop_oldest", "collapse", "disconnect")
+
+# Gộp nhiều event thành 1 frame array (client bật khi login)
+BATCH_WINDOW_MIN = 0.002  # giây
+BATCH_WINDOW_MAX = 0.02   # giây
+
+class Outbox:
+    """Hàng đợi gửi riêng cho 1 kết nối, có task writer riêng
+
+    Mỗi phần tử là (frame, key, thời điểm đưa vào). key khác None nghĩa là
+    event không quan trọng (typing, userlist...) và có thể gộp / bỏ đi.
+    """
+
+    def __init__(self, ws, codec=JSON, maxsize=OUTBOX_SIZE, policy=OUTBOX_POLICY, lag_limit=OUTBOX_LAG_LIMIT):
+        if policy not in POLICIES:
+            raise ValueError(f"Policy không hợp lệ: {policy}")
+        self.ws = ws
+        self.codec = codec
+        self.maxsize = maxsize
+        self.policy = policy
+        self.lag_limit = lag_limit
+        self.queue = deque()
+        self.dropped = 0
+        self.closed = False
+        self.batch = False
+        self.window = 0.0  # cửa sổ gộp hiện tại, 0 khi server rảnh
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._writer())
+
+    def depth(self):
+        """Số frame đang chờ gửi"""
+        return len(self.queue)
+
+    def lag(self):
+        """Thời gian (giây) frame cũ nhất đã nằm trong hàng đợi"""
+        if not self.queue:
+            return 0.0
+        return time.monotonic() - self.queue[0][2]
+
+    def push(self, frame, key=None):
+        """Đưa frame vào hàng đợi, trả về False nếu kết nối đã bị đóng"""
+        if self.closed:
+            return False
+
+        # Gộp event cùng loại: chỉ giữ bản mới nhất
+        if key is not None and self.policy == "collapse":
+            for i, item in enumerate(self.queue):
+                if item[1] == key:
+                    del self.queue[i]
+                    self.dropped += 1
+                    break
+
+        if len(self.queue) >= self.maxsize:
+            if self.policy == "disconnect":
+                self._overflow()
+                return False
+            self._drop_one()
+
+        self.queue.append((frame, key, time.monotonic()))
+
+        if self.policy == "disconnect" and self.lag() > self.lag_limit:
+            self._overflow()
+            return False
+
+        self._wakeup.set()
+        return True
+
+    def _drop_one(self):
+        """Bỏ 1 frame khi hàng đợi đầy"""
+        if self.policy == "collapse":
+            # Ưu tiên bỏ event không quan trọng cũ nhất
+            for i, item in enumerate(self.queue):
+                if item[1] is not None:
+                    del self.queue[i]
+                    self.dropped += 1
+                    return
+        self.queue.popleft()
+        self.dropped += 1
+
+    def _overflow(self):
+        """Client quá chậm: ngắt kết nối"""
+        print(f"🐢 Ngắt client chậm ({len(self.queue)} frame, trễ {self.lag():.1f}s)")
+        self.closed = True
+        self.queue.clear()
+        asyncio.create_task(self.ws.close(code=1013, reason="Slow consumer"))
+
+    async def _writer(self):
+        """Task gửi lần lượt các frame trong hàng đợi"""
+        try:
+            while True:
+                while not self.queue:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                if self.batch:
+                    frame = await self._next_batch()
+                else:
+                    frame = self.queue.popleft()[0]
+                await self.ws.send(frame)
+        except Exception:
+            # Kết nối đã hỏng, handler sẽ tự dọn dẹp
+            self.closed = True
+            self.queue.clear()
+
+    async def _next_batch(self):
+        """Chờ thêm trong cửa sổ gộp rồi lấy mọi frame đang chờ thành 1 array
+
+        Cửa sổ tăng gấp đôi khi gom được nhiều event, giảm một nửa (tới 0)
+        khi chỉ có 1 event, nên lúc ít tin nhắn không bị trễ thêm.
+        """
+        if self.window:
+            await asyncio.sleep(self.window)
+        if len(self.queue) == 1:
+            self.window = self.window / 2 if self.window / 2 >= BATCH_WINDOW_MIN else 0.0
+            return self.queue.popleft()[0]
+
+        self.window = min(BATCH_WINDOW_MAX, max(BATCH_WINDOW_MIN, self.window * 2))
+        frames = [item[0] for item in self.queue]
+        self.queue.clear()
+        return self.codec.join(frames)
+
+    def close(self):
+        """Dừng writer"""
+        self.closed = True
+        self.queue.clear()
+        self._task.cancel()
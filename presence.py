@@ -0,0 +1,82 @@
+from bisect import bisect_left, insort
+from collections import defaultdict
+
+class PresenceIndex:
+    """Chỉ mục presence dùng chung cho rooms, số online và chat riêng
+
+    Mọi thay đổi đi qua join()/leave() nên 3 cấu trúc dưới đây luôn khớp nhau:
+      - members: room -> set(ws)
+      - refs: room -> {username: số kết nối}, kèm danh sách username đã sắp xếp
+      - sockets: username -> set(ws) (thay cho private_chats)
+    """
+
+    def __init__(self):
+        self.members = defaultdict(set)
+        self.refs = defaultdict(dict)
+        self.sorted_users = defaultdict(list)
+        self.sockets = defaultdict(set)
+
+    def join(self, room, username, ws):
+        """Thêm kết nối vào room, trả về True nếu đây là kết nối đầu tiên của user"""
+        if ws in self.members[room]:
+            return False
+        self.members[room].add(ws)
+        self.sockets[username].add(ws)
+
+        refs = self.refs[room]
+        refs[username] = refs.get(username, 0) + 1
+        if refs[username] == 1:
+            insort(self.sorted_users[room], username)
+            return True
+        return False
+
+    def leave(self, room, username, ws):
+        """Bỏ kết nối khỏi room, trả về True nếu user không còn kết nối nào trong room"""
+        if ws not in self.members.get(room, ()):
+            return False
+        self.members[room].discard(ws)
+        if not self.members[room]:
+            del self.members[room]
+
+        refs = self.refs[room]
+        refs[username] -= 1
+        if refs[username] > 0:
+            return False
+
+        del refs[username]
+        users = self.sorted_users[room]
+        del users[bisect_left(users, username)]
+        if not refs:
+            del self.refs[room]
+            del self.sorted_users[room]
+        return True
+
+    def disconnect(self, username, ws):
+        """Kết nối đóng hẳn: không còn nhận tin nhắn riêng"""
+        self.sockets[username].discard(ws)
+        if not self.sockets[username]:
+            del self.sockets[username]
+
+    def room_sockets(self, room):
+        """Các kết nối đang ở trong room"""
+        return self.members.get(room, ())
+
+    def users(self, room):
+        """Danh sách username online đã sắp xếp (chỉ đọc, không được sửa)"""
+        return self.sorted_users.get(room, [])
+
+    def count(self, room):
+        """Số user online (khác nhau) trong room"""
+        return len(self.refs.get(room, ()))
+
+    def connections(self, room, username):
+        """Số kết nối của username trong room"""
+        return self.refs.get(room, {}).get(username, 0)
+
+    def is_online(self, username):
+        """User có đang kết nối không"""
+        return username in self.sockets
+
+    def sockets_of(self, username):
+        """Các kết nối của user (để gửi tin nhắn riêng)"""
+        return list(self.sockets.get(username, ()))
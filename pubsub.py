@@ -0,0 +1,178 @@
+import asyncio
+import json
+import os
+import time
+
+from broker import LINE_LIMIT
+
+# Pub/sub giữa các node chat (worker hoặc server instance khác nhau)
+#   CHAT_PUBSUB=""        : không dùng (1 process)
+#   CHAT_PUBSUB="memory"  : trong cùng process
+#   CHAT_PUBSUB="broker"  : qua broker.py, địa chỉ CHAT_BROKER ("host:port" hoặc "unix:/path")
+PUBSUB_BACKEND = os.environ.get("CHAT_PUBSUB", "")
+BROKER_ADDRESS = os.environ.get("CHAT_BROKER", "127.0.0.1:8766")
+# Mất kết nối broker: thử lại sau BROKER_RECONNECT_MS, mỗi lần lỗi chờ gấp đôi, tối đa BROKER_RECONNECT_MAX_MS
+BROKER_RECONNECT_MS = float(os.environ.get("CHAT_BROKER_RECONNECT_MS", "200"))
+BROKER_RECONNECT_MAX_MS = float(os.environ.get("CHAT_BROKER_RECONNECT_MAX_MS", "5000"))
+
+class DeliveryStats:
+    """Độ trễ giao event giữa các node (tính từ lúc publish)"""
+
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, event):
+        elapsed_ms = max(0.0, (time.time() - event["ts"]) * 1000)
+        self.count += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+
+    def report(self):
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total_ms / self.count, 3) if self.count else 0.0,
+            "max_ms": round(self.max_ms, 3)
+        }
+
+class MemoryHub:
+    """Các node MemoryPubSub cùng process"""
+
+    def __init__(self):
+        self.nodes = []
+
+default_hub = MemoryHub()
+
+class MemoryPubSub:
+    """Backend trong process: event đi qua hàng đợi của từng node"""
+
+    def __init__(self, node_id, on_event, hub=default_hub):
+        self.node_id = node_id
+        self.on_event = on_event
+        self.hub = hub
+        self.stats = DeliveryStats()
+        self.queue = asyncio.Queue()
+        self._task = None
+
+    async def connect(self):
+        self.hub.nodes.append(self)
+        self._task = asyncio.create_task(self._reader_loop())
+        self.publish({"kind": "hello"})
+
+    def publish(self, event):
+        """Gửi event cho các node khác (không chờ)"""
+        event["node"] = self.node_id
+        event["ts"] = time.time()
+        for node in self.hub.nodes:
+            if node is not self:
+                node.queue.put_nowait(json.loads(json.dumps(event)))
+
+    async def _reader_loop(self):
+        while True:
+            event = await self.queue.get()
+            if "ts" in event:
+                self.stats.record(event)
+            try:
+                await self.on_event(event)
+            except Exception as e:
+                print(f"Pub/sub event error: {e}")
+
+    async def close(self):
+        self.hub.nodes.remove(self)
+        self._task.cancel()
+        for node in self.hub.nodes:
+            node.queue.put_nowait({"kind": "node_down", "node": self.node_id})
+
+class BrokerPubSub:
+    """Backend qua mạng: kết nối tới broker.py (TCP hoặc Unix socket), tự kết nối lại khi mất kết nối"""
+
+    def __init__(self, node_id, on_event, address=BROKER_ADDRESS):
+        self.node_id = node_id
+        self.on_event = on_event
+        self.address = address
+        self.stats = DeliveryStats()
+        self.writer = None
+        self.reconnects = 0
+        self._task = None
+
+    async def connect(self):
+        """Kết nối broker và bắt đầu nhận event"""
+        reader = await self._open()
+        self._task = asyncio.create_task(self._reader_loop(reader))
+        self.publish({"kind": "hello"})
+
+    async def _open(self):
+        if self.address.startswith("unix:"):
+            reader, self.writer = await asyncio.open_unix_connection(
+                self.address[len("unix:"):], limit=LINE_LIMIT
+            )
+        else:
+            host, port = self.address.rsplit(":", 1)
+            reader, self.writer = await asyncio.open_connection(host, int(port), limit=LINE_LIMIT)
+        return reader
+
+    def publish(self, event):
+        """Gửi event cho các node khác (không chờ); đang mất kết nối broker thì event bị bỏ"""
+        if self.writer is None:
+            return
+        event["node"] = self.node_id
+        event["ts"] = time.time()
+        self.writer.write(json.dumps(event).encode() + b"\n")
+
+    async def _reconnect(self):
+        """Kết nối lại tới khi được; báo node này (reconnected) để đồng bộ lại presence rồi gửi hello"""
+        self.writer.close()
+        self.writer = None
+        delay = BROKER_RECONNECT_MS / 1000
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                reader = await self._open()
+                break
+            except OSError:
+                delay = min(delay * 2, BROKER_RECONNECT_MAX_MS / 1000)
+        self.reconnects += 1
+        print("✅ Đã kết nối lại broker")
+        try:
+            await self.on_event({"kind": "reconnected", "node": self.node_id})
+        except Exception as e:
+            print(f"Pub/sub event error: {e}")
+        self.publish({"kind": "hello"})
+        return reader
+
+    async def _reader_loop(self, reader):
+        while True:
+            try:
+                line = await reader.readline()
+            except ConnectionError:
+                line = b""
+            except ValueError:
+                print("Pub/sub event error: event dài quá LINE_LIMIT, bỏ qua")
+                continue
+            if not line:
+                print("❌ Mất kết nối broker, đang kết nối lại...")
+                reader = await self._reconnect()
+                continue
+            try:
+                event = json.loads(line)
+                if "ts" in event:
+                    self.stats.record(event)
+                await self.on_event(event)
+            except Exception as e:
+                print(f"Pub/sub event error: {e}")
+
+    async def close(self):
+        self._task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+def create_pubsub(node_id, on_event, backend=PUBSUB_BACKEND, address=BROKER_ADDRESS):
+    """Tạo backend theo cấu hình, None nếu không dùng pub/sub"""
+    if not backend:
+        return None
+    if backend == "memory":
+        return MemoryPubSub(node_id, on_event)
+    if backend == "broker":
+        return BrokerPubSub(node_id, on_event, address)
+    raise ValueError(f"Backend pub/sub không hợp lệ: {backend}")
@@ -0,0 +1,344 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+
+# mysql-connector là tùy chọn: chỉ cần khi CHAT_STORAGE=mysql
+try:
+    import mysql.connector
+    import mysql.connector.pooling
+except ImportError:
+    mysql = None
+
+# Chọn nơi lưu dữ liệu: sqlite (chat.db, mặc định) | mysql
+CHAT_STORAGE = os.environ.get("CHAT_STORAGE", "sqlite")
+MYSQL_HOST = os.environ.get("MYSQL_HOST", "localhost")
+MYSQL_PORT = int(os.environ.get("MYSQL_PORT", "3306"))
+MYSQL_USER = os.environ.get("MYSQL_USER", "root")
+MYSQL_PASSWORD = os.environ.get("MYSQL_PASSWORD", "")
+MYSQL_DATABASE = os.environ.get("MYSQL_DATABASE", "chat_app")
+MYSQL_POOL_SIZE = int(os.environ.get("MYSQL_POOL_SIZE", "8"))
+
+class Repository:
+    """API lưu trữ bất đồng bộ dùng chung cho mọi backend (không hàm nào chặn event loop)"""
+
+    name = None
+
+    def init(self):
+        """Tạo bảng / migrate (1 lần trong process chính, trước khi fork worker)"""
+
+    async def open(self):
+        """Mở kết nối / pool (gọi trong process sẽ dùng, sau khi fork)"""
+
+    async def close(self):
+        """Ghi nốt dữ liệu đang chờ rồi đóng kết nối"""
+
+    # Users
+    async def create_user(self, username, hashed):
+        raise NotImplementedError
+
+    async def get_password_hash(self, username):
+        raise NotImplementedError
+
+    async def set_user_role(self, username, role):
+        """True nếu có user để đổi"""
+        raise NotImplementedError
+
+    async def list_users(self):
+        """[(username, role), ...] theo thứ tự tên"""
+        raise NotImplementedError
+
+    # Tin nhắn
+    async def save_message(self, room, sender, message, msg_type="text"):
+        """Lưu tin nhắn room, trả về id"""
+        raise NotImplementedError
+
+    async def save_private_message(self, sender, receiver, message):
+        raise NotImplementedError
+
+    async def load_messages(self, room, limit=100, before_id=None):
+        """Tin nhắn của room (cũ -> mới), before_id: phân trang keyset"""
+        raise NotImplementedError
+
+    async def load_messages_since(self, room, since_id, limit=100):
+        raise NotImplementedError
+
+    async def load_private_messages(self, user1, user2, limit=50):
+        raise NotImplementedError
+
+    # File đính kèm
+    async def save_blob_meta(self, digest, mime, size):
+        raise NotImplementedError
+
+    async def get_blob_meta(self, digest):
+        raise NotImplementedError
+
+    async def save_blob_variant(self, digest, variant, variant_hash):
+        raise NotImplementedError
+
+    async def get_blob_variant(self, digest, variant):
+        raise NotImplementedError
+
+    def stats(self):
+        return {"backend": self.name}
+
+class SqliteRepository(Repository):
+    """chat.db: ghi qua db.WriteBehind (group commit), đọc qua reader pool (WAL)"""
+
+    name = "sqlite"
+
+    def init(self):
+        db.init_db()
+
+    async def open(self):
+        db.start_writer()
+        db.start_readers()
+
+    async def close(self):
+        db.stop_readers()
+        db.stop_writer()
+
+    async def create_user(self, username, hashed):
+        await asyncio.wrap_future(db.queue_user(username, hashed))
+
+    async def get_password_hash(self, username):
+        return await db.read(db.get_password_hash, username)
+
+    async def set_user_role(self, username, role):
+        return await asyncio.wrap_future(db.queue_user_role(username, role)) > 0
+
+    async def list_users(self):
+        return await db.read(db.get_all_users)
+
+    async def save_message(self, room, sender, message, msg_type="text"):
+        return await asyncio.wrap_future(db.queue_message(room, sender, message, msg_type))
+
+    async def save_private_message(self, sender, receiver, message):
+        await asyncio.wrap_future(db.queue_private_message(sender, receiver, message))
+
+    async def load_messages(self, room, limit=100, before_id=None):
+        return await db.read(db.load_messages, room, limit, before_id)
+
+    async def load_messages_since(self, room, since_id, limit=100):
+        return await db.read(db.load_messages_since, room, since_id, limit)
+
+    async def load_private_messages(self, user1, user2, limit=50):
+        return await db.read(db.load_private_messages, user1, user2, limit)
+
+    async def save_blob_meta(self, digest, mime, size):
+        await asyncio.wrap_future(db.queue_blob_meta(digest, mime, size))
+
+    async def get_blob_meta(self, digest):
+        return await db.read(db.get_blob_meta, digest)
+
+    async def save_blob_variant(self, digest, variant, variant_hash):
+        await asyncio.wrap_future(db.queue_blob_variant(digest, variant, variant_hash))
+
+    async def get_blob_variant(self, digest, variant):
+        return await db.read(db.get_blob_variant, digest, variant)
+
+    def stats(self):
+        return {"backend": self.name, "readers": db.readers.stats() if db.readers else None}
+
+MYSQL_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS users (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        username VARCHAR(64) NOT NULL UNIQUE,
+        password VARCHAR(255) NOT NULL,
+        role VARCHAR(16) NOT NULL DEFAULT 'user',
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    ) CHARACTER SET utf8mb4""",
+    """CREATE TABLE IF NOT EXISTS messages (
+        id BIGINT AUTO_INCREMENT PRIMARY KEY,
+        room VARCHAR(64) NOT NULL,
+        sender VARCHAR(64) NOT NULL,
+        message MEDIUMTEXT NOT NULL,
+        msg_type VARCHAR(16) NOT NULL DEFAULT 'text',
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        INDEX idx_messages_room_id (room, id)
+    ) CHARACTER SET utf8mb4""",
+    """CREATE TABLE IF NOT EXISTS private_messages (
+        id BIGINT AUTO_INCREMENT PRIMARY KEY,
+        sender VARCHAR(64) NOT NULL,
+        receiver VARCHAR(64) NOT NULL,
+        message MEDIUMTEXT NOT NULL,
+        conversation VARCHAR(130) NOT NULL,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        INDEX idx_private_conversation_id (conversation, id)
+    ) CHARACTER SET utf8mb4""",
+    """CREATE TABLE IF NOT EXISTS blobs (
+        hash CHAR(64) PRIMARY KEY,
+        mime VARCHAR(128) NOT NULL,
+        size BIGINT NOT NULL,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )""",
+    """CREATE TABLE IF NOT EXISTS blob_variants (
+        hash CHAR(64) NOT NULL,
+        variant VARCHAR(16) NOT NULL,
+        variant_hash CHAR(64) NOT NULL,
+        PRIMARY KEY (hash, variant)
+    )""",
+]
+
+def _message_row(r):
+    return {"id": r[0], "sender": r[1], "message": r[2], "type": r[3], "time": r[4]}
+
+class MysqlRepository(Repository):
+    """MySQL / MariaDB: pool connection của mysql-connector, query chạy trên thread pool cùng cỡ"""
+
+    name = "mysql"
+
+    def __init__(self, pool_size=MYSQL_POOL_SIZE):
+        if mysql is None:
+            raise RuntimeError("CHAT_STORAGE=mysql cần: pip install mysql-connector-python")
+        self.pool_size = pool_size
+        self.pool = None
+        self.executor = None
+        self.count = 0
+        self.run_ms = 0.0
+
+    async def open(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="mysql")
+        await self._run(self._connect)
+        await self._run(self._init_schema)
+
+    async def close(self):
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
+
+    def _connect(self):
+        self.pool = mysql.connector.pooling.MySQLConnectionPool(
+            pool_name="chat", pool_size=self.pool_size,
+            host=MYSQL_HOST, port=MYSQL_PORT, user=MYSQL_USER,
+            password=MYSQL_PASSWORD, database=MYSQL_DATABASE,
+            time_zone="+00:00"  # CURRENT_TIMESTAMP lưu theo UTC giống SQLite, giờ trả về cùng múi với server.py
+        )
+
+    def _init_schema(self):
+        conn = self.pool.get_connection()
+        try:
+            cur = conn.cursor()
+            for sql in MYSQL_SCHEMA:
+                cur.execute(sql)
+            cur.execute("SELECT 1 FROM users WHERE username='admin'")
+            if cur.fetchone() is None:
+                # IGNORE: nhiều worker cùng mở lần đầu
+                cur.execute(
+                    "INSERT IGNORE INTO users (username, password, role) VALUES (%s, %s, %s)",
+                    ("admin", db.hash_password("admin123"), "admin")
+                )
+            conn.commit()
+        finally:
+            conn.close()
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    def _query(self, sql, params=(), fetch="all"):
+        """Chạy 1 câu SQL trên connection mượn từ pool (trong thread của executor)"""
+        started = time.perf_counter()
+        conn = self.pool.get_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute(sql, params)
+            if fetch == "all":
+                result = cur.fetchall()
+            elif fetch == "one":
+                result = cur.fetchone()
+            else:
+                conn.commit()
+                result = cur.lastrowid if fetch == "lastrowid" else cur.rowcount
+            cur.close()
+            return result
+        finally:
+            conn.close()  # trả connection về pool
+            self.count += 1
+            self.run_ms += (time.perf_counter() - started) * 1000
+
+    async def query(self, sql, params=(), fetch="all"):
+        return await self._run(self._query, sql, params, fetch)
+
+    async def create_user(self, username, hashed):
+        await self.query("INSERT INTO users (username, password) VALUES (%s, %s)", (username, hashed), "lastrowid")
+
+    async def get_password_hash(self, username):
+        row = await self.query("SELECT password FROM users WHERE username=%s", (username,), "one")
+        return row[0] if row else None
+
+    async def set_user_role(self, username, role):
+        return await self.query("UPDATE users SET role=%s WHERE username=%s", (role, username), "rowcount") > 0
+
+    async def list_users(self):
+        return await self.query("SELECT username, role FROM users ORDER BY username")
+
+    async def save_message(self, room, sender, message, msg_type="text"):
+        return await self.query(
+            "INSERT INTO messages (room, sender, message, msg_type) VALUES (%s, %s, %s, %s)",
+            (room, sender, message, msg_type), "lastrowid"
+        )
+
+    async def save_private_message(self, sender, receiver, message):
+        await self.query(
+            "INSERT INTO private_messages (sender, receiver, message, conversation) VALUES (%s, %s, %s, %s)",
+            (sender, receiver, message, db.conversation_key(sender, receiver)), "lastrowid"
+        )
+
+    async def load_messages(self, room, limit=100, before_id=None):
+        rows = await self.query(
+            """SELECT id, sender, message, msg_type, DATE_FORMAT(created_at, '%%H:%%i')
+               FROM messages WHERE room=%s AND id<%s ORDER BY id DESC LIMIT %s""",
+            (room, before_id if before_id is not None else 2 ** 63 - 1, limit)
+        )
+        return [_message_row(r) for r in reversed(rows)]
+
+    async def load_messages_since(self, room, since_id, limit=100):
+        rows = await self.query(
+            """SELECT id, sender, message, msg_type, DATE_FORMAT(created_at, '%%H:%%i')
+               FROM messages WHERE room=%s AND id>%s ORDER BY id LIMIT %s""",
+            (room, since_id, limit)
+        )
+        return [_message_row(r) for r in rows]
+
+    async def load_private_messages(self, user1, user2, limit=50):
+        rows = await self.query(
+            """SELECT sender, receiver, message, DATE_FORMAT(created_at, '%%H:%%i')
+               FROM private_messages WHERE conversation=%s ORDER BY id DESC LIMIT %s""",
+            (db.conversation_key(user1, user2), limit)
+        )
+        return [{"sender": r[0], "receiver": r[1], "message": r[2], "time": r[3]} for r in reversed(rows)]
+
+    async def save_blob_meta(self, digest, mime, size):
+        await self.query("INSERT IGNORE INTO blobs (hash, mime, size) VALUES (%s, %s, %s)", (digest, mime, size), "rowcount")
+
+    async def get_blob_meta(self, digest):
+        row = await self.query("SELECT mime, size FROM blobs WHERE hash=%s", (digest,), "one")
+        return {"mime": row[0], "size": row[1]} if row else None
+
+    async def save_blob_variant(self, digest, variant, variant_hash):
+        await self.query(
+            "REPLACE INTO blob_variants (hash, variant, variant_hash) VALUES (%s, %s, %s)",
+            (digest, variant, variant_hash), "rowcount"
+        )
+
+    async def get_blob_variant(self, digest, variant):
+        row = await self.query(
+            "SELECT variant_hash FROM blob_variants WHERE hash=%s AND variant=%s", (digest, variant), "one"
+        )
+        return row[0] if row else None
+
+    def stats(self):
+        return {
+            "backend": self.name,
+            "pool_size": self.pool_size,
+            "count": self.count,
+            "avg_run_ms": round(self.run_ms / self.count, 3) if self.count else 0.0
+        }
+
+def create_repository(backend=CHAT_STORAGE):
+    """Repository theo cấu hình CHAT_STORAGE"""
+    if backend == "mysql":
+        return MysqlRepository()
+    return SqliteRepository()
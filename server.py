@@ -1,317 +1,995 @@
-import asyncio
-import websockets
-import json
-import hashlib
-from datetime import datetime
-from collections import defaultdict
-from db import (
-    init_db, save_message, load_messages, 
-    verify_user, create_user, get_user_role,
-    save_private_message, load_private_messages,
-    get_all_users
-)
-
-# Khởi tạo
-init_db()
-
-# Biến toàn cục
-clients = {}              # ws -> {username, room, role}
-rooms = defaultdict(set)  # room -> set(ws)
-private_chats = {}        # username -> ws
-
-def online_in_room(room):
-    """Số user online trong room"""
-    return len(rooms[room])
-
-def get_online_users(room):
-    """Lấy danh sách user online trong room"""
-    users = []
-    for ws in rooms[room]:
-        if ws in clients and clients[ws]:
-            users.append(clients[ws]["username"])
-    return users
-
-async def broadcast(room, data, exclude_ws=None):
-    """Gửi tin nhắn đến tất cả trong room"""
-    dead = []
-    for ws in rooms[room]:
-        if ws == exclude_ws:
-            continue
-        try:
-            await ws.send(json.dumps(data))
-        except:
-            dead.append(ws)
-    
-    # Xóa các connection bị hỏng
-    for ws in dead:
-        rooms[room].discard(ws)
-        if ws in clients:
-            del clients[ws]
-
-async def send_userlist(room):
-    """Gửi danh sách user online"""
-    users = get_online_users(room)
-    await broadcast(room, {
-        "type": "userlist",
-        "users": users,
-        "count": len(users)
-    })
-
-async def handler(ws, path):
-    """Xử lý kết nối WebSocket"""
-    clients[ws] = None
-    
-    try:
-        async for raw in ws:
-            try:
-                data = json.loads(raw)
-            except:
-                continue
-            
-            # ========= REGISTER =========
-            if data["type"] == "register":
-                username = data.get("username", "").strip()
-                password = data.get("password", "").strip()
-                
-                if not username or not password:
-                    await ws.send(json.dumps({
-                        "type": "error",
-                        "message": "Username và password không được để trống"
-                    }))
-                    continue
-                
-                if len(username) < 3:
-                    await ws.send(json.dumps({
-                        "type": "error",
-                        "message": "Username phải có ít nhất 3 ký tự"
-                    }))
-                    continue
-                
-                try:
-                    create_user(username, password)
-                    await ws.send(json.dumps({
-                        "type": "register_ok",
-                        "message": "Đăng ký thành công!"
-                    }))
-                except:
-                    await ws.send(json.dumps({
-                        "type": "error",
-                        "message": "Username đã tồn tại"
-                    }))
-
-            # ========= LOGIN =========
-            elif data["type"] == "login":
-                username = data.get("username", "").strip()
-                password = data.get("password", "").strip()
-                room = data.get("room", "general")
-                
-                if not username or not password:
-                    await ws.send(json.dumps({
-                        "type": "login_fail",
-                        "message": "Vui lòng nhập username và password"
-                    }))
-                    continue
-                
-                # Xác thực user
-                if verify_user(username, password):
-                    role = get_user_role(username)
-                    clients[ws] = {
-                        "username": username,
-                        "room": room,
-                        "role": role
-                    }
-                    rooms[room].add(ws)
-                    private_chats[username] = ws
-                    
-                    # Gửi thông tin đăng nhập thành công
-                    await ws.send(json.dumps({
-                        "type": "login_success",
-                        "username": username,
-                        "role": role,
-                        "room": room,
-                        "online": online_in_room(room),
-                        "history": load_messages(room),
-                        "all_users": get_all_users()
-                    }))
-                    
-                    # Thông báo user mới online
-                    await broadcast(room, {
-                        "type": "system",
-                        "message": f"🎉 {username} đã tham gia phòng"
-                    }, exclude_ws=ws)
-                    
-                    # Gửi danh sách user online
-                    await send_userlist(room)
-                    
-                else:
-                    await ws.send(json.dumps({
-                        "type": "login_fail",
-                        "message": "Sai username hoặc password"
-                    }))
-
-            # ========= PUBLIC MESSAGE =========
-            elif data["type"] == "message":
-                if not clients.get(ws):
-                    continue
-                
-                user = clients[ws]
-                room = user["room"]
-                sender = user["username"]
-                message = data.get("message", "").strip()
-                
-                if not message:
-                    continue
-                
-                # Lưu tin nhắn
-                msg_id = save_message(room, sender, message)
-                
-                # Gửi đến mọi người trong room
-                await broadcast(room, {
-                    "type": "message",
-                    "sender": sender,
-                    "message": message,
-                    "room": room,
-                    "time": datetime.now().strftime("%H:%M"),
-                    "id": msg_id
-                })
-
-            # ========= PRIVATE MESSAGE =========
-            elif data["type"] == "private_message":
-                if not clients.get(ws):
-                    continue
-                
-                sender = clients[ws]["username"]
-                receiver = data.get("to", "").strip()
-                message = data.get("message", "").strip()
-                
-                if not message or not receiver:
-                    continue
-                
-                # Lưu tin nhắn riêng
-                save_private_message(sender, receiver, message)
-                
-                # Gửi cho người nhận nếu online
-                if receiver in private_chats:
-                    try:
-                        await private_chats[receiver].send(json.dumps({
-                            "type": "private_message",
-                            "from": sender,
-                            "message": message,
-                            "time": datetime.now().strftime("%H:%M")
-                        }))
-                    except:
-                        pass
-                
-                # Gửi xác nhận cho người gửi
-                await ws.send(json.dumps({
-                    "type": "private_sent",
-                    "to": receiver,
-                    "message": message,
-                    "time": datetime.now().strftime("%H:%M")
-                }))
-
-            # ========= SWITCH ROOM =========
-            elif data["type"] == "switch_room":
-                if not clients.get(ws):
-                    continue
-                
-                user = clients[ws]
-                old_room = user["room"]
-                new_room = data.get("room", "general")
-                
-                if old_room == new_room:
-                    continue
-                
-                # Rời phòng cũ
-                rooms[old_room].discard(ws)
-                
-                # Thông báo rời phòng
-                await broadcast(old_room, {
-                    "type": "system",
-                    "message": f"👋 {user['username']} đã rời phòng"
-                })
-                
-                # Vào phòng mới
-                user["room"] = new_room
-                rooms[new_room].add(ws)
-                
-                # Gửi lịch sử tin nhắn phòng mới
-                await ws.send(json.dumps({
-                    "type": "room_switched",
-                    "room": new_room,
-                    "online": online_in_room(new_room),
-                    "history": load_messages(new_room)
-                }))
-                
-                # Thông báo vào phòng mới
-                await broadcast(new_room, {
-                    "type": "system",
-                    "message": f"🎉 {user['username']} đã tham gia phòng"
-                })
-                
-                # Cập nhật danh sách user cả 2 phòng
-                await send_userlist(old_room)
-                await send_userlist(new_room)
-
-            # ========= GET USERS =========
-            elif data["type"] == "get_users":
-                await ws.send(json.dumps({
-                    "type": "all_users",
-                    "users": get_all_users()
-                }))
-
-            # ========= TYPING =========
-            elif data["type"] == "typing":
-                if not clients.get(ws):
-                    continue
-                
-                user = clients[ws]
-                await broadcast(user["room"], {
-                    "type": "typing",
-                    "user": user["username"],
-                    "is_typing": data.get("is_typing", False)
-                }, exclude_ws=ws)
-
-    except websockets.exceptions.ConnectionClosed:
-        pass
-    finally:
-        # Xử lý khi client disconnect
-        user = clients.get(ws)
-        if user:
-            username = user["username"]
-            room = user["room"]
-            
-            # Xóa khỏi room
-            rooms[room].discard(ws)
-            
-            # Xóa khỏi private chats
-            if username in private_chats:
-                del private_chats[username]
-            
-            # Thông báo user offline
-            await broadcast(room, {
-                "type": "system",
-                "message": f"👋 {username} đã rời khỏi"
-            })
-            
-            # Cập nhật danh sách user
-            await send_userlist(room)
-        
-        # Xóa client
-        if ws in clients:
-            del clients[ws]
-
-async def main():
-    """Khởi chạy server"""
-    print("=" * 50)
-    print("🚀 WebSocket Chat Server")
-    print("📡 Đang chạy tại ws://localhost:8765")
-    print("📊 Database: chat.db")
-    print("=" * 50)
-    
-    # SỬA DÒNG NÀY - ĐÂY LÀ CÁCH SỬA ĐƠN GIẢN NHẤT
-    async with websockets.serve(lambda ws, path: handler(ws, path), "0.0.0.0", 8765):
-        await asyncio.Future()  # Chạy mãi mãi
-
-if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+import asyncio
+import base64
+import websockets
+import hashlib
+import os
+import signal
+import socket
+import time
+from datetime import datetime, timezone
+from urllib.parse import parse_qs, quote
+from collections import defaultdict
+from outbox import Outbox
+from blobstore import (
+    INLINE_MIME, DEFAULT_MIME, attachment_ref, is_valid_digest, normalize_mime, read_blob, read_blob_range,
+    split_inline_attachment, store_attachment
+)
+from user_directory import UserDirectory
+from uploads import UPLOAD_CHUNK_MAX, UploadError, UploadManager, is_chunk_frame, parse_chunk
+from codec import SUBPROTOCOLS, codec_for
+from hash_pool import HashPool, PoolBusy
+from image_pool import VARIANT_SIZES, ImagePool
+from history_cache import HistoryCache
+from presence import PresenceIndex
+from static import StaticFiles, etag_matches, parse_range, response
+from broker import bind_unix_socket, run_broker
+from pubsub import BrokerPubSub, create_pubsub
+import db
+from db import hash_password, verify_password
+from repository import create_repository
+
+# Khởi tạo
+repo = create_repository()  # SQLite (mặc định) hoặc MySQL theo CHAT_STORAGE
+repo.init()
+
+# Biến toàn cục
+clients = {}              # ws -> {username, room, role}
+presence = PresenceIndex()  # room -> ws / username, username -> ws (thay rooms + private_chats)
+outboxes = {}             # ws -> Outbox (hàng đợi gửi riêng)
+hash_pool = HashPool()    # bcrypt chạy ở thread pool, không chặn event loop
+image_pool = ImagePool(repo)  # thumbnail / bản hiển thị của ảnh, chạy ở process pool
+history_cache = HistoryCache(None)  # room -> N tin nhắn gần nhất (nạp bất đồng bộ qua load_room)
+upload_manager = UploadManager()  # upload file lớn theo chunk, nối tiếp được
+static_files = StaticFiles()      # trang web phục vụ cùng cổng (HTTP thường)
+user_directory = UserDirectory()  # username -> role, có version để gửi delta (nạp trong main)
+
+# Lịch sử gửi kèm khi vào phòng chỉ là trang đầu, phần cũ hơn client tự xin bằng load_more
+HISTORY_PAGE = int(os.environ.get("HISTORY_PAGE", "30"))
+HISTORY_PAGE_MAX = 100
+SYNC_MAX = int(os.environ.get("SYNC_MAX", "200"))  # thiếu quá số tin này thì gửi lại từ đầu
+
+# Nhiều node (worker cùng máy hoặc server khác sau load balancer) trao đổi qua pub/sub
+CHAT_PORT = int(os.environ.get("CHAT_PORT", "8765"))
+CHAT_WORKERS = int(os.environ.get("CHAT_WORKERS", "1"))
+BUS_PATH = os.environ.get("CHAT_BUS_PATH", "/tmp/chat_bus.sock")
+node_id = f"{socket.gethostname()}-{os.getpid()}"
+pubsub = None             # backend pub/sub (None khi chạy 1 process)
+remote_conns = defaultdict(dict)  # node -> {token: (room, username)} của node khác
+
+def online_in_room(room):
+    """Số user online trong room"""
+    return presence.count(room)
+
+def get_online_users(room):
+    """Lấy danh sách user online trong room (đã sắp xếp)"""
+    return presence.users(room)
+
+# Thống kê thời gian broadcast theo kích thước room (làm tròn lên lũy thừa 2)
+BROADCAST_SLOW_MS = 50
+broadcast_stats = defaultdict(lambda: {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+
+def record_broadcast(size, elapsed_ms):
+    """Ghi nhận thời gian 1 lần broadcast"""
+    bucket = 1 << (size - 1).bit_length()
+    stat = broadcast_stats[bucket]
+    stat["count"] += 1
+    stat["total_ms"] += elapsed_ms
+    stat["max_ms"] = max(stat["max_ms"], elapsed_ms)
+    if elapsed_ms >= BROADCAST_SLOW_MS:
+        print(f"🐢 Broadcast chậm: {size} người nhận, {elapsed_ms:.1f} ms")
+
+def get_broadcast_stats():
+    """Thời gian broadcast trung bình / lớn nhất theo kích thước room"""
+    return [
+        {
+            "room_size": bucket,
+            "count": stat["count"],
+            "avg_ms": round(stat["total_ms"] / stat["count"], 3),
+            "max_ms": round(stat["max_ms"], 3)
+        }
+        for bucket, stat in sorted(broadcast_stats.items())
+    ]
+
+def collapse_key(data):
+    """Khóa gộp cho event không quan trọng (None = không được bỏ)"""
+    if data["type"] == "typing":
+        return "typing"
+    if data["type"] == "userlist":
+        return "userlist"
+    return None
+
+async def send(ws, data):
+    """Đưa 1 event vào hàng đợi gửi của client"""
+    outbox = outboxes.get(ws)
+    if outbox:
+        outbox.push(outbox.codec.encode(data), collapse_key(data))
+
+async def fanout(targets, data):
+    """Encode 1 lần cho mỗi codec rồi đưa vào hàng đợi của từng client trong targets"""
+    if not targets:
+        return
+    
+    start = time.perf_counter()
+    frames = {}  # codec -> frame đã encode
+    key = collapse_key(data)
+    for ws in targets:
+        outbox = outboxes.get(ws)
+        if outbox:
+            frame = frames.get(outbox.codec.name)
+            if frame is None:
+                frame = frames[outbox.codec.name] = outbox.codec.encode(data)
+            outbox.push(frame, key)
+    record_broadcast(len(targets), (time.perf_counter() - start) * 1000)
+
+def utc_time():
+    """Giờ gửi HH:MM theo UTC, cùng múi giờ với created_at trong DB (trình duyệt đổi sang giờ địa phương)"""
+    return datetime.now(timezone.utc).strftime("%H:%M")
+
+def cache_message(payload):
+    """Thêm tin nhắn vừa lưu vào cache lịch sử của room"""
+    history_cache.append(payload["room"], {
+        "id": payload["id"],
+        "sender": payload["sender"],
+        "message": payload["message"],
+        "type": payload.get("msg_type", "text"),
+        "time": payload["time"]
+    })
+
+async def store_attachments(data):
+    """Ảnh/file trong tin nhắn -> lưu vào blob store, trả về (message đã thay bằng tham chiếu, msg_type)"""
+    if isinstance(data.get("attachment"), bytes):
+        # Client binary (msgpack/cbor) gửi thẳng bytes
+        raw = data["attachment"]
+        mime = normalize_mime(data.get("mime"))
+        name = data.get("name")
+    else:
+        message = data.get("message", "").strip()
+        inline = split_inline_attachment(message)
+        if inline is None:
+            return message, "text"
+        raw, mime, name = inline
+
+    # Hash + ghi đĩa ở thread riêng, không chặn event loop
+    message, msg_type, digest = await asyncio.to_thread(store_attachment, raw, mime, name)
+    await repo.save_blob_meta(digest, mime, len(raw))
+    if msg_type == "image":
+        image_pool.schedule(digest, mime)
+    return message, msg_type
+
+async def post_message(room, sender, message, msg_type="text"):
+    """Lưu tin nhắn rồi gửi đến mọi người trong room"""
+    # Ghi theo lô ở thread riêng, chờ commit để có id
+    msg_id = await repo.save_message(room, sender, message, msg_type)
+    
+    payload = {
+        "type": "message",
+        "sender": sender,
+        "message": message,
+        "msg_type": msg_type,
+        "room": room,
+        "time": utc_time(),
+        "id": msg_id
+    }
+    cache_message(payload)
+    await broadcast(room, payload)
+
+async def post_private_message(ws, sender, receiver, message):
+    """Lưu tin nhắn riêng, gửi cho người nhận (nếu online) và xác nhận cho người gửi"""
+    await repo.save_private_message(sender, receiver, message)
+    
+    payload = {
+        "type": "private_message",
+        "from": sender,
+        "message": message,
+        "time": utc_time()
+    }
+    for target in presence.sockets_of(receiver):
+        await send(target, payload)
+    publish({"kind": "private", "user": receiver, "data": payload})
+    
+    await send(ws, {
+        "type": "private_sent",
+        "to": receiver,
+        "message": message,
+        "time": utc_time()
+    })
+
+async def handle_chunk(ws, raw):
+    """Ghi 1 chunk upload ra đĩa, đủ dữ liệu thì đưa vào blob store và gửi tin nhắn"""
+    username = clients[ws]["username"]
+    upload_id = None
+    try:
+        upload_id, offset, chunk = parse_chunk(raw)
+        upload = upload_manager.uploads.get(upload_id)
+        if upload is None or upload.owner != username:
+            raise UploadError("Upload không tồn tại hoặc đã hết hạn")
+        upload = await asyncio.to_thread(upload_manager.write, upload_id, offset, chunk)
+    except UploadError as e:
+        await send(ws, {"type": "upload_error", "upload_id": upload_id, "message": str(e)})
+        return
+    
+    await send(ws, {"type": "upload_ack", "upload_id": upload_id, "offset": upload.received})
+    if not upload.complete:
+        return
+    
+    digest = await asyncio.to_thread(upload_manager.finish, upload)
+    await repo.save_blob_meta(digest, upload.mime, upload.size)
+    name = None if upload.mime in INLINE_MIME else upload.name
+    message, msg_type = attachment_ref(digest, upload.mime, name)
+    if msg_type == "image":
+        image_pool.schedule(digest, upload.mime)
+    await send(ws, {"type": "upload_done", "upload_id": upload_id, "hash": digest})
+    
+    if "to" in upload.target:
+        await post_private_message(ws, username, upload.target["to"], message)
+    else:
+        await post_message(upload.target["room"], username, message, msg_type)
+
+async def load_room(room):
+    """Nạp cache lịch sử của room qua repository (query không chạy trên event loop)"""
+    if history_cache.loaded(room):
+        return
+    history_cache.begin_load(room)
+    try:
+        items = await repo.load_messages(room, history_cache.size)
+    except BaseException:
+        history_cache.cancel_load(room)
+        raise
+    history_cache.finish_load(room, items)
+
+def first_page(room):
+    """Trang lịch sử mới nhất của room + cờ còn tin cũ hơn"""
+    history = history_cache.get(room)
+    return history[-HISTORY_PAGE:], len(history) > HISTORY_PAGE
+
+async def history_for(room, since_id=None):
+    """Lịch sử khi vào phòng: chỉ phần thiếu từ since_id nếu được, không thì trang đầu"""
+    await load_room(room)
+    if since_id is not None:
+        missing = history_cache.since(room, since_id)
+        if missing is None:
+            missing = await repo.load_messages_since(room, since_id, SYNC_MAX + 1)
+        if len(missing) <= SYNC_MAX:
+            return {"history": missing, "sync": "delta"}
+    
+    # Client mới hoặc bị tụt quá xa: gửi lại trang đầu (room có thể đã bị đẩy khỏi cache lúc chờ query)
+    await load_room(room)
+    history, has_more = first_page(room)
+    return {"history": history, "has_more": has_more, "sync": "full"}
+
+def parse_since_id(data):
+    """Lấy since_id (id tin nhắn cuối client đã có) từ request"""
+    try:
+        return int(data["since_id"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+async def load_page(room, before_id, limit):
+    """Trang tin nhắn cũ hơn before_id: từ cache nếu có, không thì keyset query trên DB"""
+    page = history_cache.page(room, before_id, limit)
+    if page is None:
+        page = await repo.load_messages(room, limit, before_id)
+    return page
+
+def local_sockets(room, exclude_ws=None):
+    """Kết nối của node này trong room (bỏ qua kết nối của node khác)"""
+    return [ws for ws in presence.room_sockets(room) if ws in outboxes and ws != exclude_ws]
+
+def publish(event):
+    """Gửi event cho các node khác (không làm gì khi chạy 1 process)"""
+    if pubsub:
+        pubsub.publish(event)
+
+async def broadcast(room, data, exclude_ws=None):
+    """Gửi tin nhắn đến tất cả trong room (encode 1 lần, đưa vào hàng đợi từng client)"""
+    await fanout(local_sockets(room, exclude_ws), data)
+    publish({"kind": "room", "room": room, "data": data})
+
+def get_queue_stats(limit=20):
+    """Độ sâu hàng đợi gửi của các client (sâu nhất trước)"""
+    stats = [
+        {
+            "username": clients[ws]["username"] if clients.get(ws) else None,
+            "depth": outbox.depth(),
+            "lag_ms": round(outbox.lag() * 1000, 1),
+            "dropped": outbox.dropped
+        }
+        for ws, outbox in outboxes.items()
+    ]
+    stats.sort(key=lambda s: s["depth"], reverse=True)
+    return stats[:limit]
+
+# ========= TYPING (gộp theo room) =========
+TYPING_INTERVAL = 0.5   # giây giữa 2 frame typing của 1 room
+TYPING_TTL = 3.0        # tự hết hạn nếu không nhận thêm typing
+
+typing_state = defaultdict(dict)  # room -> {username: hạn hết typing}
+typing_dirty = set()              # các room cần gửi lại danh sách typing
+
+def set_typing(room, username, is_typing):
+    """Cập nhật trạng thái typing, chỉ đánh dấu room khi danh sách thay đổi"""
+    state = typing_state[room]
+    if is_typing:
+        if username not in state:
+            typing_dirty.add(room)
+        state[username] = time.monotonic() + TYPING_TTL
+    elif state.pop(username, None) is not None:
+        typing_dirty.add(room)
+
+async def typing_flusher():
+    """Mỗi TYPING_INTERVAL gửi tối đa 1 frame "ai đang gõ" cho mỗi room"""
+    while True:
+        await asyncio.sleep(TYPING_INTERVAL)
+        now = time.monotonic()
+        for room, state in list(typing_state.items()):
+            expired = [u for u, deadline in state.items() if deadline <= now]
+            for u in expired:
+                del state[u]
+            if expired:
+                typing_dirty.add(room)
+            if not state:
+                del typing_state[room]
+        
+        dirty = list(typing_dirty)
+        typing_dirty.clear()
+        for room in dirty:
+            await fanout(local_sockets(room), {
+                "type": "typing",
+                "users": sorted(typing_state.get(room, ()))
+            })
+
+def userlist_payload(room):
+    """Danh sách user online đầy đủ (cho client cũ)"""
+    users = get_online_users(room)
+    return {
+        "type": "userlist",
+        "users": users,
+        "count": len(users)
+    }
+
+# ========= PRESENCE (snapshot + delta có số thứ tự) =========
+presence_seq = defaultdict(int)  # room -> số thứ tự thay đổi presence
+
+def presence_snapshot(room):
+    """Toàn bộ presence của room kèm số thứ tự hiện tại"""
+    users = get_online_users(room)
+    return {
+        "type": "presence_snapshot",
+        "room": room,
+        "users": users,
+        "count": len(users),
+        "seq": presence_seq[room]
+    }
+
+def join_room(ws, room):
+    """Đưa kết nối vào room và báo cho các node khác"""
+    username = clients[ws]["username"]
+    publish({"kind": "presence", "op": "join", "room": room, "user": username, "conn": id(ws)})
+    return presence.join(room, username, ws)
+
+def leave_room(ws, room):
+    """Đưa kết nối ra khỏi room và báo cho các node khác"""
+    username = clients[ws]["username"]
+    publish({"kind": "presence", "op": "leave", "room": room, "user": username, "conn": id(ws)})
+    set_typing(room, username, False)
+    return presence.leave(room, username, ws)
+
+async def presence_update(room, op, username, changed, joined_ws=None):
+    """Báo user join/leave: delta cho client hỗ trợ, userlist đầy đủ cho client cũ
+
+    changed là kết quả presence.join()/leave() (user thực sự vào / rời room).
+    Client vừa vào phòng (joined_ws) nhận snapshot / userlist riêng.
+    """
+    delta_targets = []
+    legacy_targets = []
+    for ws in presence.room_sockets(room):
+        if ws == joined_ws or not clients.get(ws):
+            continue
+        if clients[ws].get("presence_delta"):
+            delta_targets.append(ws)
+        else:
+            legacy_targets.append(ws)
+    
+    if changed:
+        presence_seq[room] += 1
+        userlist = userlist_payload(room)
+        await fanout(delta_targets, {
+            "type": "presence",
+            "room": room,
+            "op": op,
+            "user": username,
+            "count": userlist["count"],
+            "seq": presence_seq[room]
+        })
+        await fanout(legacy_targets, userlist)
+    
+    if joined_ws is not None:
+        if clients[joined_ws].get("presence_delta"):
+            await send(joined_ws, presence_snapshot(room))
+        else:
+            await send(joined_ws, userlist_payload(room))
+
+async def handler(ws, path):
+    """Xử lý kết nối WebSocket"""
+    clients[ws] = None
+    codec = codec_for(ws.subprotocol)
+    outboxes[ws] = Outbox(ws, codec)
+    
+    try:
+        async for raw in ws:
+            # Chunk binary của upload không đi qua codec
+            if is_chunk_frame(raw):
+                if clients.get(ws):
+                    await handle_chunk(ws, raw)
+                continue
+            
+            try:
+                data = codec.decode(raw)
+            except:
+                continue
+            
+            # ========= REGISTER =========
+            if data["type"] == "register":
+                username = data.get("username", "").strip()
+                password = data.get("password", "").strip()
+                
+                if not username or not password:
+                    await send(ws, {
+                        "type": "error",
+                        "message": "Username và password không được để trống"
+                    })
+                    continue
+                
+                if len(username) < 3:
+                    await send(ws, {
+                        "type": "error",
+                        "message": "Username phải có ít nhất 3 ký tự"
+                    })
+                    continue
+                
+                try:
+                    if user_directory.exists(username):
+                        raise ValueError(username)
+                    hashed = await hash_pool.run(hash_password, password)
+                    await repo.create_user(username, hashed)
+                    user_directory.upsert(username, "user")
+                    publish({"kind": "user", "user": username, "role": "user"})
+                    await send(ws, {
+                        "type": "register_ok",
+                        "message": "Đăng ký thành công!"
+                    })
+                except PoolBusy:
+                    await send(ws, {
+                        "type": "error",
+                        "busy": True,
+                        "message": "Server đang bận, vui lòng thử lại sau giây lát"
+                    })
+                except:
+                    await send(ws, {
+                        "type": "error",
+                        "message": "Username đã tồn tại"
+                    })
+
+            # ========= LOGIN =========
+            elif data["type"] == "login":
+                username = data.get("username", "").strip()
+                password = data.get("password", "").strip()
+                room = data.get("room", "general")
+                
+                if not username or not password:
+                    await send(ws, {
+                        "type": "login_fail",
+                        "message": "Vui lòng nhập username và password"
+                    })
+                    continue
+                
+                # Xác thực user (bcrypt chạy trên hash_pool)
+                hashed = await repo.get_password_hash(username)
+                try:
+                    ok = bool(hashed) and await hash_pool.run(verify_password, password, hashed)
+                except PoolBusy:
+                    await send(ws, {
+                        "type": "login_fail",
+                        "busy": True,
+                        "message": "Server đang bận, vui lòng thử lại sau giây lát"
+                    })
+                    continue
+                
+                if ok:
+                    role = user_directory.role(username)
+                    # Lịch sử lấy trước khi vào room: tin nhắn đến trong lúc chờ query không bị gửi 2 lần
+                    # (vào room ngay sau đó, không có await xen giữa nên cũng không bị sót)
+                    history = await history_for(room, parse_since_id(data))
+                    clients[ws] = {
+                        "username": username,
+                        "room": room,
+                        "role": role,
+                        "presence_delta": data.get("presence") == "delta"
+                    }
+                    changed = join_room(ws, room)
+                    
+                    # Client hỗ trợ nhận nhiều event trong 1 frame (JSON array)
+                    outboxes[ws].batch = bool(data.get("batch"))
+                    
+                    # Gửi thông tin đăng nhập thành công
+                    await send(ws, {
+                        "type": "login_success",
+                        "username": username,
+                        "role": role,
+                        "room": room,
+                        "batch": outboxes[ws].batch,
+                        "online": online_in_room(room),
+                        "users_version": user_directory.tag(),
+                        **history
+                    })
+                    
+                    # Thông báo user mới online
+                    await broadcast(room, {
+                        "type": "system",
+                        "message": f"🎉 {username} đã tham gia phòng"
+                    }, exclude_ws=ws)
+                    
+                    # Gửi danh sách user online
+                    await presence_update(room, "join", username, changed, joined_ws=ws)
+                    
+                else:
+                    await send(ws, {
+                        "type": "login_fail",
+                        "message": "Sai username hoặc password"
+                    })
+
+            # ========= PUBLIC MESSAGE =========
+            elif data["type"] == "message":
+                if not clients.get(ws):
+                    continue
+                
+                user = clients[ws]
+                room = user["room"]
+                sender = user["username"]
+                message, msg_type = await store_attachments(data)
+                
+                if not message:
+                    continue
+                
+                await post_message(room, sender, message, msg_type)
+
+            # ========= PRIVATE MESSAGE =========
+            elif data["type"] == "private_message":
+                if not clients.get(ws):
+                    continue
+                
+                sender = clients[ws]["username"]
+                receiver = data.get("to", "").strip()
+                message, _ = await store_attachments(data)
+                
+                if not message or not receiver:
+                    continue
+                
+                await post_private_message(ws, sender, receiver, message)
+
+            # ========= SWITCH ROOM =========
+            elif data["type"] == "switch_room":
+                if not clients.get(ws):
+                    continue
+                
+                user = clients[ws]
+                old_room = user["room"]
+                new_room = data.get("room", "general")
+                
+                if old_room == new_room:
+                    continue
+                
+                # Rời phòng cũ
+                left = leave_room(ws, old_room)
+                
+                # Thông báo rời phòng
+                await broadcast(old_room, {
+                    "type": "system",
+                    "message": f"👋 {user['username']} đã rời phòng"
+                })
+                
+                # Lịch sử phòng mới lấy trước, rồi mới vào phòng (như login)
+                history = await history_for(new_room, parse_since_id(data))
+                user["room"] = new_room
+                joined = join_room(ws, new_room)
+                
+                # Gửi lịch sử tin nhắn phòng mới
+                await send(ws, {
+                    "type": "room_switched",
+                    "room": new_room,
+                    "online": online_in_room(new_room),
+                    **history
+                })
+                
+                # Thông báo vào phòng mới
+                await broadcast(new_room, {
+                    "type": "system",
+                    "message": f"🎉 {user['username']} đã tham gia phòng"
+                })
+                
+                # Cập nhật danh sách user cả 2 phòng
+                await presence_update(old_room, "leave", user["username"], left)
+                await presence_update(new_room, "join", user["username"], joined, joined_ws=ws)
+
+            # ========= LOAD MORE (phân trang lịch sử) =========
+            elif data["type"] == "load_more":
+                if not clients.get(ws):
+                    continue
+                
+                room = clients[ws]["room"]
+                try:
+                    before_id = int(data["before_id"])
+                    limit = max(1, min(int(data.get("limit", HISTORY_PAGE)), HISTORY_PAGE_MAX))
+                except (KeyError, TypeError, ValueError):
+                    continue
+                
+                page = await load_page(room, before_id, limit)
+                await send(ws, {
+                    "type": "history_page",
+                    "room": room,
+                    "before_id": before_id,
+                    "messages": page,
+                    "has_more": len(page) == limit
+                })
+
+            # ========= UPLOAD (file lớn, gửi theo chunk binary) =========
+            elif data["type"] == "upload_start":
+                if not clients.get(ws):
+                    continue
+                
+                user = clients[ws]
+                receiver = str(data.get("to") or "").strip()
+                target = {"to": receiver} if receiver else {"room": user["room"]}
+                try:
+                    upload = upload_manager.start(
+                        user["username"],
+                        str(data.get("name") or "file"),
+                        normalize_mime(data.get("mime")),
+                        data.get("size"),
+                        target,
+                        upload_id=data.get("upload_id")
+                    )
+                except UploadError as e:
+                    await send(ws, {"type": "upload_error", "upload_id": data.get("upload_id"), "message": str(e)})
+                    continue
+                
+                # offset > 0 khi nối tiếp: client gửi tiếp từ byte này
+                await send(ws, {
+                    "type": "upload_ready",
+                    "upload_id": upload.id,
+                    "offset": upload.received,
+                    "chunk_size": UPLOAD_CHUNK_MAX
+                })
+
+            elif data["type"] == "upload_cancel":
+                upload = upload_manager.uploads.get(data.get("upload_id"))
+                if upload and clients.get(ws) and upload.owner == clients[ws]["username"]:
+                    upload_manager.abort(upload.id)
+
+            # ========= GET BLOB (tải file đính kèm theo hash) =========
+            elif data["type"] == "get_blob":
+                if not clients.get(ws):
+                    continue
+
+                digest = data.get("hash")
+                meta = await repo.get_blob_meta(digest) if is_valid_digest(digest) else None
+                if not meta:
+                    await send(ws, {"type": "error", "message": "File không tồn tại"})
+                    continue
+
+                # Ảnh: gửi bản thu nhỏ nếu client xin (ảnh gốc chỉ khi bấm xem)
+                served = digest
+                variant = data.get("variant")
+                if variant in VARIANT_SIZES:
+                    await image_pool.wait(digest)
+                    served = await repo.get_blob_variant(digest, variant) or digest
+                    if served != digest:
+                        meta = await repo.get_blob_meta(served) or meta
+
+                raw = await asyncio.to_thread(read_blob, served)
+                mime = normalize_mime(meta["mime"])
+                await send(ws, {
+                    "type": "blob",
+                    "hash": digest,
+                    "variant": variant if variant in VARIANT_SIZES else None,
+                    "mime": mime,
+                    "message": f"data:{mime};base64,{base64.b64encode(raw).decode('ascii')}"
+                })
+
+            # ========= GET USERS =========
+            elif data["type"] == "get_users":
+                # Client gửi version đang có: nhận unchanged / delta thay vì cả bảng users
+                await send(ws, {
+                    "type": "all_users",
+                    **user_directory.diff(data.get("version"))
+                })
+
+            # ========= SET ROLE (ADMIN) =========
+            elif data["type"] == "set_role":
+                if not clients.get(ws) or clients[ws]["role"] != "admin":
+                    continue
+                
+                target = data.get("username", "").strip()
+                role = data.get("role")
+                if role not in ("user", "admin") or not await repo.set_user_role(target, role):
+                    await send(ws, {"type": "error", "message": "Không đổi được role"})
+                    continue
+                
+                user_directory.upsert(target, role)
+                publish({"kind": "user", "user": target, "role": role})
+                for user in clients.values():
+                    if user and user["username"] == target:
+                        user["role"] = role
+                await send(ws, {"type": "role_set", "username": target, "role": role})
+
+            # ========= PRESENCE RESYNC =========
+            elif data["type"] == "presence_resync":
+                if not clients.get(ws):
+                    continue
+                
+                await send(ws, presence_snapshot(clients[ws]["room"]))
+
+            # ========= STATS (ADMIN) =========
+            elif data["type"] == "stats":
+                if not clients.get(ws) or clients[ws]["role"] != "admin":
+                    continue
+                
+                await send(ws, {
+                    "type": "stats",
+                    "broadcast": get_broadcast_stats(),
+                    "queues": get_queue_stats(),
+                    "pubsub": pubsub.stats.report() if pubsub else None,
+                    "hash_pool": hash_pool.stats(),
+                    "history_cache": history_cache.stats(),
+                    "uploads": upload_manager.stats(),
+                    "image_pool": image_pool.stats(),
+                    "static": static_files.stats(),
+                    "user_directory": user_directory.stats(),
+                    "storage": repo.stats()
+                })
+
+            # ========= TYPING =========
+            elif data["type"] == "typing":
+                if not clients.get(ws):
+                    continue
+                
+                user = clients[ws]
+                is_typing = data.get("is_typing", False)
+                set_typing(user["room"], user["username"], is_typing)
+                publish({"kind": "typing", "room": user["room"], "user": user["username"], "is_typing": is_typing})
+
+    except websockets.exceptions.ConnectionClosed:
+        pass
+    finally:
+        # Xử lý khi client disconnect
+        user = clients.get(ws)
+        if user:
+            username = user["username"]
+            room = user["room"]
+            
+            # Xóa khỏi room
+            left = leave_room(ws, room)
+            
+            # Xóa khỏi private chats
+            presence.disconnect(username, ws)
+            
+            # Thông báo user offline
+            await broadcast(room, {
+                "type": "system",
+                "message": f"👋 {username} đã rời khỏi"
+            })
+            
+            # Cập nhật danh sách user
+            await presence_update(room, "leave", username, left)
+        
+        # Xóa client
+        if ws in clients:
+            del clients[ws]
+        outboxes.pop(ws).close()
+
+# ========= HTTP (cùng cổng với WebSocket) =========
+async def serve_blob(path, request_headers):
+    """GET /blobs/<hash>[?variant=thumb&name=...]: nội dung không bao giờ đổi nên cache vĩnh viễn, hỗ trợ Range"""
+    digest, _, query = path[len("/blobs/"):].partition("?")
+    params = parse_qs(query)
+    meta = await repo.get_blob_meta(digest) if is_valid_digest(digest) else None
+    if not meta:
+        return response(404, body=b"Not found\n")
+    
+    served = digest
+    cache_control = "public, max-age=31536000, immutable"
+    variant = params.get("variant", [None])[0]
+    if variant in VARIANT_SIZES:
+        await image_pool.wait(digest)
+        stored = await repo.get_blob_variant(digest, variant)
+        if stored is None:
+            # Chưa có bản thu nhỏ (lỗi / thiếu Pillow): tạm trả ảnh gốc, không cho cache cứng URL này
+            cache_control = "no-cache"
+        else:
+            served = stored
+            meta = await repo.get_blob_meta(served) or meta
+    
+    # Nội dung do người dùng upload: không cho trình duyệt chạy như trang của origin chat
+    # (chỉ ảnh raster hiển thị trực tiếp, còn lại tải về dạng file nhị phân)
+    mime = normalize_mime(meta["mime"])
+    inline = mime in INLINE_MIME
+    headers = [
+        ("Content-Type", mime if inline else DEFAULT_MIME),
+        ("X-Content-Type-Options", "nosniff"),
+        ("Content-Security-Policy", "sandbox"),
+        ("ETag", f'"{served}"'),
+        ("Accept-Ranges", "bytes"),
+        ("Cache-Control", cache_control)
+    ]
+    if "name" in params:
+        headers.append(("Content-Disposition", f"attachment; filename*=UTF-8''{quote(params['name'][0])}"))
+    elif not inline:
+        headers.append(("Content-Disposition", "attachment"))
+    if etag_matches(request_headers, f'"{served}"'):
+        return response(304, headers)
+    
+    size = meta["size"]
+    try:
+        byte_range = parse_range(request_headers.get("Range"), size)
+    except ValueError:
+        return response(416, headers + [("Content-Range", f"bytes */{size}")])
+    if byte_range is None:
+        return response(200, headers, await asyncio.to_thread(read_blob, served))
+    
+    start, end = byte_range
+    body = await asyncio.to_thread(read_blob_range, served, start, end - start + 1)
+    return response(206, headers + [("Content-Range", f"bytes {start}-{end}/{size}")], body)
+
+async def http_request(path, request_headers):
+    """Request HTTP thường trên cổng chat: trang web + file đính kèm (None = tiếp tục bắt tay WebSocket)"""
+    if request_headers.get("Upgrade", "").lower() == "websocket":
+        return None
+    if path.startswith("/blobs/"):
+        return await serve_blob(path, request_headers)
+    return await static_files.serve(path, request_headers) or response(404, body=b"Not found\n")
+
+# ========= PUB/SUB (nhiều node) =========
+async def remote_presence(node, op, room, username, conn):
+    """Áp dụng join/leave của kết nối thuộc node khác"""
+    token = f"{node}:{conn}"
+    if op == "join":
+        remote_conns[node][token] = (room, username)
+        changed = presence.join(room, username, token)
+    else:
+        remote_conns[node].pop(token, None)
+        changed = presence.leave(room, username, token)
+        presence.disconnect(username, token)
+        set_typing(room, username, False)
+    await presence_update(room, op, username, changed)
+
+def announce_presence():
+    """Publish join cho mọi kết nối đang đăng nhập ở node này"""
+    for ws, user in clients.items():
+        if user:
+            publish({"kind": "presence", "op": "join", "room": user["room"], "user": user["username"], "conn": id(ws)})
+
+async def on_pubsub_event(event):
+    """Xử lý event do node khác gửi tới"""
+    kind = event["kind"]
+    node = event["node"]
+    
+    if kind == "room":
+        if event["data"]["type"] == "message":
+            cache_message(event["data"])
+        await fanout(local_sockets(event["room"]), event["data"])
+    
+    elif kind == "private":
+        for target in presence.sockets_of(event["user"]):
+            if target in outboxes:
+                await send(target, event["data"])
+    
+    elif kind == "presence":
+        await remote_presence(node, event["op"], event["room"], event["user"], event["conn"])
+    
+    elif kind == "user":
+        user_directory.upsert(event["user"], event["role"])
+        for user in clients.values():
+            if user and user["username"] == event["user"]:
+                user["role"] = event["role"]
+    
+    elif kind == "typing":
+        set_typing(event["room"], event["user"], event["is_typing"])
+    
+    elif kind == "hello":
+        # Node mới khởi động (hoặc vừa kết nối lại broker): gửi lại presence của các kết nối ở đây
+        announce_presence()
+    
+    elif kind == "reconnected":
+        # Node này vừa kết nối lại broker: event lúc mất kết nối đã lỡ, bỏ presence của node khác
+        # (họ gửi lại khi nhận hello) và báo lại presence ở đây (broker đã báo node_down cho node này)
+        for other in list(remote_conns):
+            await on_pubsub_event({"kind": "node_down", "node": other})
+        announce_presence()
+    
+    elif kind == "node_down":
+        for token, (room, username) in list(remote_conns.pop(node, {}).items()):
+            await remote_presence(node, "leave", room, username, token.split(":", 1)[1])
+        remote_conns.pop(node, None)
+
+async def main(multi_worker=False):
+    """Khởi chạy server"""
+    global pubsub
+    print("=" * 50)
+    print(f"🚀 WebSocket Chat Server (node {node_id})")
+    print(f"📡 Đang chạy tại ws://localhost:{CHAT_PORT} (trang web: http://localhost:{CHAT_PORT}/)")
+    print(f"📊 Database: {repo.name}")
+    print("=" * 50)
+    
+    asyncio.create_task(typing_flusher())
+    
+    if multi_worker:
+        pubsub = BrokerPubSub(node_id, on_pubsub_event, "unix:" + BUS_PATH)
+    else:
+        pubsub = create_pubsub(node_id, on_pubsub_event)
+    if pubsub:
+        await pubsub.connect()
+    
+    image_pool.start()  # fork process xử lý ảnh trước khi có thread ghi DB
+    await repo.open()
+    await asyncio.to_thread(static_files.preload)  # nén sẵn trang web trước khi nhận request
+    user_directory.fill(await repo.list_users())  # nạp danh bạ user trước khi nhận kết nối
+    
+    # Ctrl+C / SIGTERM: dừng nhận kết nối rồi ghi nốt tin nhắn đang chờ
+    loop = asyncio.get_running_loop()
+    stop = loop.create_future()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, lambda: stop.done() or stop.set_result(None))
+        except NotImplementedError:
+            pass  # Windows: Ctrl+C vẫn hủy main() và chạy finally
+    
+    try:
+        # SỬA DÒNG NÀY - ĐÂY LÀ CÁCH SỬA ĐƠN GIẢN NHẤT
+        async with websockets.serve(lambda ws, path: handler(ws, path), "0.0.0.0", CHAT_PORT,
+                                    subprotocols=SUBPROTOCOLS, reuse_port=multi_worker,
+                                    process_request=http_request):
+            await stop  # Chạy tới khi có tín hiệu dừng
+    finally:
+        image_pool.stop()
+        await repo.close()
+
+def run_workers(count):
+    """Fork count worker cùng nghe CHAT_PORT (SO_REUSEPORT), process cha làm broker qua Unix socket"""
+    global node_id
+    broker_sock = bind_unix_socket(BUS_PATH)
+    
+    # Không dùng chung kết nối SQLite qua fork: mỗi worker tự mở kết nối riêng
+    db.close()
+    
+    children = []
+    for _ in range(count):
+        pid = os.fork()
+        if pid == 0:
+            broker_sock.close()
+            node_id = f"{socket.gethostname()}-{os.getpid()}"
+            db.reconnect()
+            try:
+                asyncio.run(main(multi_worker=True))
+            finally:
+                os._exit(0)
+        children.append(pid)
+    
+    print(f"🧩 Đã khởi động {count} worker: {children}")
+    try:
+        asyncio.run(run_broker(sock=broker_sock))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except ProcessLookupError:
+                pass
+        os.unlink(BUS_PATH)
+
+if __name__ == "__main__":
+    if CHAT_WORKERS > 1:
+        run_workers(CHAT_WORKERS)
+    else:
+        asyncio.run(main())
\ No newline at end of file
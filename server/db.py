@@ -2,7 +2,7 @@ import sqlite3
 import bcrypt
 from datetime import datetime
 
-# Kết nối database
+# Kết nối database (các hàm bên dưới chạy trên thread của asyncio.to_thread: mỗi lần gọi dùng cursor riêng)
 conn = sqlite3.connect("chat.db", check_same_thread=False)
 cur = conn.cursor()
 
@@ -64,13 +64,13 @@ def verify_password(password, hashed):
 
 def user_exists(username):
     """Kiểm tra user đã tồn tại chưa"""
-    cur.execute("SELECT 1 FROM users WHERE username=?", (username,))
+    cur = conn.execute("SELECT 1 FROM users WHERE username=?", (username,))
     return cur.fetchone() is not None
 
 def create_user(username, password):
     """Tạo user mới"""
     hashed = hash_password(password)
-    cur.execute(
+    cur = conn.execute(
         "INSERT INTO users (username, password) VALUES (?, ?)",
         (username, hashed)
     )
@@ -79,7 +79,7 @@ def create_user(username, password):
 
 def verify_user(username, password):
     """Xác thực user"""
-    cur.execute("SELECT password FROM users WHERE username=?", (username,))
+    cur = conn.execute("SELECT password FROM users WHERE username=?", (username,))
     row = cur.fetchone()
     if row:
         return verify_password(password, row[0])
@@ -87,13 +87,13 @@ def verify_user(username, password):
 
 def get_user_role(username):
     """Lấy role của user"""
-    cur.execute("SELECT role FROM users WHERE username=?", (username,))
+    cur = conn.execute("SELECT role FROM users WHERE username=?", (username,))
     row = cur.fetchone()
     return row[0] if row else "user"
 
 def save_message(room, sender, message, msg_type="text"):
     """Lưu tin nhắn"""
-    cur.execute(
+    cur = conn.execute(
         "INSERT INTO messages (room, sender, message, msg_type) VALUES (?, ?, ?, ?)",
         (room, sender, message, msg_type)
     )
@@ -102,7 +102,7 @@ def save_message(room, sender, message, msg_type="text"):
 
 def save_private_message(sender, receiver, message):
     """Lưu tin nhắn riêng"""
-    cur.execute(
+    cur = conn.execute(
         "INSERT INTO private_messages (sender, receiver, message) VALUES (?, ?, ?)",
         (sender, receiver, message)
     )
@@ -110,7 +110,7 @@ def save_private_message(sender, receiver, message):
 
 def load_messages(room, limit=100):
     """Tải tin nhắn của room"""
-    cur.execute(
+    cur = conn.execute(
         """SELECT sender, message, msg_type, 
            strftime('%H:%M', created_at) as time 
            FROM messages 
@@ -131,7 +131,7 @@ def load_messages(room, limit=100):
 
 def load_private_messages(user1, user2, limit=50):
     """Tải tin nhắn riêng giữa 2 user"""
-    cur.execute(
+    cur = conn.execute(
         """SELECT sender, receiver, message, 
            strftime('%H:%M', created_at) as time 
            FROM private_messages 
@@ -152,12 +152,12 @@ def load_private_messages(user1, user2, limit=50):
 
 def get_all_users():
     """Lấy danh sách tất cả users"""
-    cur.execute("SELECT username, role FROM users ORDER BY username")
+    cur = conn.execute("SELECT username, role FROM users ORDER BY username")
     return cur.fetchall()
 
 def delete_message(msg_id):
     """Xóa tin nhắn (cho admin)"""
-    cur.execute("DELETE FROM messages WHERE id=?", (msg_id,))
+    cur = conn.execute("DELETE FROM messages WHERE id=?", (msg_id,))
     conn.commit()
     return cur.rowcount > 0
 
@@ -2,6 +2,7 @@ import asyncio
 import websockets
 import json
 import hashlib
+import time
 from datetime import datetime
 from collections import defaultdict
 from db import (
@@ -10,6 +11,7 @@ from db import (
     save_private_message, load_private_messages,
     get_all_users
 )
+from session import issue_token, verify_token, revoke_token
 
 # Khởi tạo DB
 init_db()
@@ -32,24 +34,53 @@ def get_online_users(room):
     # Sắp xếp và loại bỏ trùng lặp
     return sorted(list(set(users)))
 
+# Thống kê thời gian broadcast theo kích thước room (làm tròn lên lũy thừa 2)
+BROADCAST_SLOW_MS = 50
+broadcast_stats = defaultdict(lambda: {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+
+def record_broadcast(size, elapsed_ms):
+    """Ghi nhận thời gian 1 lần broadcast"""
+    bucket = 1 << (size - 1).bit_length()
+    stat = broadcast_stats[bucket]
+    stat["count"] += 1
+    stat["total_ms"] += elapsed_ms
+    stat["max_ms"] = max(stat["max_ms"], elapsed_ms)
+    if elapsed_ms >= BROADCAST_SLOW_MS:
+        print(f"🐢 Broadcast chậm: {size} người nhận, {elapsed_ms:.1f} ms")
+
+def get_broadcast_stats():
+    """Thời gian broadcast trung bình / lớn nhất theo kích thước room"""
+    return [
+        {
+            "room_size": bucket,
+            "count": stat["count"],
+            "avg_ms": round(stat["total_ms"] / stat["count"], 3),
+            "max_ms": round(stat["max_ms"], 3)
+        }
+        for bucket, stat in sorted(broadcast_stats.items())
+    ]
+
 async def broadcast(room, data, exclude_ws=None):
-    """Gửi tin nhắn đến tất cả trong room"""
+    """Gửi tin nhắn đến tất cả trong room (encode 1 lần, gửi song song)"""
     if room not in rooms: return
     
-    dead = []
-    for ws in rooms[room]:
-        if ws == exclude_ws:
-            continue
-        try:
-            await ws.send(json.dumps(data))
-        except:
-            dead.append(ws)
+    targets = [ws for ws in rooms[room] if ws != exclude_ws]
+    if not targets: return
+    
+    start = time.perf_counter()
+    frame = json.dumps(data)
+    results = await asyncio.gather(
+        *(ws.send(frame) for ws in targets),
+        return_exceptions=True
+    )
+    record_broadcast(len(targets), (time.perf_counter() - start) * 1000)
     
     # Xóa các connection bị hỏng
-    for ws in dead:
-        rooms[room].discard(ws)
-        if ws in clients:
-            del clients[ws]
+    for ws, result in zip(targets, results):
+        if isinstance(result, Exception):
+            rooms[room].discard(ws)
+            if ws in clients:
+                del clients[ws]
 
 async def send_userlist(room):
     """Gửi danh sách user online cho room đó"""
@@ -75,10 +106,15 @@ async def handler(ws):
 
             # ========= 1. JOIN (Kết nối lại / F5) =========
             if msg_type == "join":
-                username = data.get("username", "").strip()
                 room = data.get("room", "general")
                 
-                role = get_user_role(username)
+                # Chỉ tin token đã ký (không tin username client tự gửi): thiếu / sai / hết hạn -> đăng nhập lại
+                claims = verify_token(data.get("token"))
+                if not claims:
+                    await ws.send(json.dumps({"type": "session_expired", "message": "Phiên đăng nhập đã hết hạn"}))
+                    continue
+                username = claims["u"]
+                role = claims["r"]
                 
                 clients[ws] = {
                     "username": username, 
@@ -96,8 +132,8 @@ async def handler(ws):
                     "username": username,
                     "role": role,
                     "room": room,
-                    "history": load_messages(room), # Gửi lịch sử ngay
-                    "all_users": get_all_users()
+                    "history": await asyncio.to_thread(load_messages, room), # Gửi lịch sử ngay
+                    "all_users": await asyncio.to_thread(get_all_users)
                 }))
                 
                 await send_userlist(room)
@@ -116,7 +152,7 @@ async def handler(ws):
                     continue
                 
                 try:
-                    if create_user(username, password):
+                    if await asyncio.to_thread(create_user, username, password):
                         await ws.send(json.dumps({"type": "register_ok", "message": "Đăng ký thành công!"}))
                     else:
                         await ws.send(json.dumps({"type": "error", "message": "Username đã tồn tại"}))
@@ -129,8 +165,9 @@ async def handler(ws):
                 password = data.get("password", "").strip()
                 room = data.get("room", "general")
                 
-                if verify_user(username, password):
-                    role = get_user_role(username)
+                # bcrypt + SQLite chạy trên thread riêng, không chặn event loop
+                if await asyncio.to_thread(verify_user, username, password):
+                    role = await asyncio.to_thread(get_user_role, username)
                     clients[ws] = {"username": username, "room": room, "role": role}
                     rooms[room].add(ws)
                     private_chats[username] = ws
@@ -140,8 +177,9 @@ async def handler(ws):
                         "username": username,
                         "role": role,
                         "room": room,
-                        "history": load_messages(room), # Gửi lịch sử
-                        "all_users": get_all_users()
+                        "token": issue_token(username, role), # Dùng cho join khi F5 / kết nối lại
+                        "history": await asyncio.to_thread(load_messages, room), # Gửi lịch sử
+                        "all_users": await asyncio.to_thread(get_all_users)
                     }))
                     
                     await broadcast(room, {
@@ -162,7 +200,7 @@ async def handler(ws):
                 message = data.get("message", "").strip()
                 
                 if message:
-                    save_message(room, sender, message)
+                    await asyncio.to_thread(save_message, room, sender, message)
                     await broadcast(room, {
                         "type": "message",
                         "sender": sender,
@@ -178,7 +216,7 @@ async def handler(ws):
                 message = data.get("message")
                 
                 if receiver:
-                    save_private_message(sender, receiver, message)
+                    await asyncio.to_thread(save_private_message, sender, receiver, message)
                     
                     payload = {
                         "type": "private_message",
@@ -206,7 +244,7 @@ async def handler(ws):
                 other = data.get("with_user")
                 await ws.send(json.dumps({
                     "type": "private_history",
-                    "history": load_private_messages(me, other),
+                    "history": await asyncio.to_thread(load_private_messages, me, other),
                     "with_user": other
                 }))
 
@@ -229,7 +267,7 @@ async def handler(ws):
                     rooms[new_room].add(ws)
                     
                     # 3. Gửi lịch sử phòng mới (QUAN TRỌNG: Key phải là 'history')
-                    history_data = load_messages(new_room)
+                    history_data = await asyncio.to_thread(load_messages, new_room)
                     await ws.send(json.dumps({
                         "type": "history",       # Client bắt type này
                         "history": history_data, # Client bắt key này để render
@@ -239,6 +277,21 @@ async def handler(ws):
                     # 4. Cập nhật list user cho phòng mới
                     await send_userlist(new_room)
 
+            # ========= 8. LOGOUT (thu hồi token) =========
+            elif msg_type == "logout":
+                if data.get("token"):
+                    revoke_token(data["token"])
+                await ws.send(json.dumps({"type": "logout_ok"}))
+
+            # ========= 9. STATS (ADMIN) =========
+            elif msg_type == "stats":
+                user = clients.get(ws)
+                if user and user["role"] == "admin":
+                    await ws.send(json.dumps({
+                        "type": "stats",
+                        "broadcast": get_broadcast_stats()
+                    }))
+
     except websockets.exceptions.ConnectionClosed:
         pass
     except Exception as e:
@@ -0,0 +1,57 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import time
+
+# Khóa ký token: đặt SESSION_SECRET để token còn hiệu lực sau khi restart server
+SESSION_SECRET = os.environ.get("SESSION_SECRET", "").encode() or secrets.token_bytes(32)
+SESSION_TTL = int(os.environ.get("SESSION_TTL", str(12 * 3600)))  # giây
+
+# Token đã thu hồi (chỉ lưu trong RAM): jti -> thời điểm hết hạn
+revoked = {}
+
+def _b64(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+def _unb64(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+def _sign(payload):
+    return hmac.new(SESSION_SECRET, payload.encode("ascii"), hashlib.sha256).digest()
+
+def issue_token(username, role):
+    """Tạo token phiên đã ký, có hạn dùng"""
+    claims = {
+        "u": username,
+        "r": role,
+        "exp": int(time.time()) + SESSION_TTL,
+        "jti": secrets.token_hex(8)
+    }
+    payload = _b64(json.dumps(claims, separators=(",", ":")).encode())
+    return payload + "." + _b64(_sign(payload))
+
+def verify_token(token):
+    """Kiểm tra chữ ký + hạn dùng, trả về claims hoặc None (không đụng tới DB/bcrypt)"""
+    try:
+        payload, signature = token.split(".")
+        if not hmac.compare_digest(_unb64(signature), _sign(payload)):
+            return None
+        claims = json.loads(_unb64(payload))
+    except (AttributeError, ValueError):
+        return None
+    if claims["exp"] < time.time() or claims["jti"] in revoked:
+        return None
+    return claims
+
+def revoke_token(token):
+    """Thu hồi token (đăng xuất)"""
+    claims = verify_token(token)
+    if claims:
+        revoked[claims["jti"]] = claims["exp"]
+        # Dọn các token đã hết hạn khỏi danh sách thu hồi
+        now = time.time()
+        for jti in [j for j, exp in revoked.items() if exp < now]:
+            del revoked[jti]
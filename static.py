@@ -0,0 +1,139 @@
+import asyncio
+import gzip
+import hashlib
+import http
+import mimetypes
+import os
+import re
+
+# brotli là tùy chọn: thiếu thì chỉ có gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Trang web phục vụ cùng cổng với WebSocket: chỉ các file trong danh sách (thư mục repo còn mã nguồn, DB...)
+STATIC_DIR = os.environ.get("STATIC_DIR", os.path.dirname(os.path.abspath(__file__)))
+STATIC_FILES = os.environ.get("STATIC_FILES", "index.html,login.html,register.html,chat.html,styles.css")
+COMPRESS_TYPES = {".html", ".css", ".js", ".svg"}
+COMPRESS_MIN = 1024  # file nhỏ hơn thì nén không đáng
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+def response(status, headers=(), body=b""):
+    """Bộ (status, headers, body) cho process_request của websockets"""
+    return http.HTTPStatus(status), list(headers), body
+
+def etag_matches(request_headers, etag):
+    """If-None-Match khớp ETag -> client dùng lại bản đã cache (304)"""
+    tags = request_headers.get("If-None-Match", "")
+    return tags.strip() == "*" or etag in [t.strip() for t in tags.split(",")]
+
+def parse_range(value, size):
+    """Header Range (1 đoạn) -> (start, end) bao gồm end; None nếu không có; ValueError nếu sai"""
+    if not value:
+        return None
+    match = RANGE_RE.match(value.strip())
+    if not match or match.groups() == ("", ""):
+        raise ValueError(value)
+    first, last = match.groups()
+    if first == "":
+        # bytes=-N: N byte cuối
+        start, end = max(0, size - int(last)), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    if start > end or start >= size:
+        raise ValueError(value)
+    return start, end
+
+class StaticFiles:
+    """Phục vụ file tĩnh: nén sẵn gzip/br 1 lần khi đọc file, ETag mạnh, trả 304 khi client đã có"""
+
+    def __init__(self, root=STATIC_DIR, names=STATIC_FILES):
+        self.root = os.path.realpath(root)
+        self.names = {n.strip() for n in names.split(",") if n.strip()}
+        self.files = {}   # path -> (mtime, {encoding: (body, etag)}, content type)
+        self.hits = 0
+        self.not_modified = 0
+
+    def resolve(self, url_path):
+        """Đường dẫn URL -> file trên đĩa, None nếu không được phép phục vụ"""
+        name = url_path.split("?", 1)[0].lstrip("/") or "index.html"
+        if name not in self.names:
+            return None
+        path = os.path.realpath(os.path.join(self.root, name))
+        if not path.startswith(self.root + os.sep) or not os.path.isfile(path):
+            return None
+        return path
+
+    def preload(self):
+        """Đọc + nén sẵn mọi file trong danh sách (gọi qua thread lúc khởi động)"""
+        for name in self.names:
+            path = self.resolve(name)
+            if path is not None:
+                self._load(path)
+
+    def _load(self, path):
+        """Đọc file + tạo sẵn bản nén, dùng lại tới khi file đổi (mtime)"""
+        mtime = os.stat(path).st_mtime_ns
+        cached = self.files.get(path)
+        if cached and cached[0] == mtime:
+            return cached
+
+        with open(path, "rb") as f:
+            body = f.read()
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        variants = {"identity": (body, f'"{digest}"')}
+        if os.path.splitext(path)[1].lower() in COMPRESS_TYPES and len(body) >= COMPRESS_MIN:
+            # Ưu tiên file nén sẵn lúc build (chat.html.br / chat.html.gz) nếu mới hơn file gốc
+            for encoding, ext in (("gzip", ".gz"), ("br", ".br")):
+                if os.path.isfile(path + ext) and os.stat(path + ext).st_mtime_ns >= mtime:
+                    with open(path + ext, "rb") as f:
+                        variants[encoding] = (f.read(), f'"{digest}-{ext[1:]}"')
+            if "gzip" not in variants:
+                variants["gzip"] = (gzip.compress(body, 9), f'"{digest}-gz"')
+            if "br" not in variants and brotli is not None:
+                variants["br"] = (brotli.compress(body), f'"{digest}-br"')
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        if content_type.startswith("text/"):
+            content_type += "; charset=utf-8"
+        cached = self.files[path] = (mtime, variants, content_type)
+        return cached
+
+    async def serve(self, url_path, request_headers):
+        """Response cho file tĩnh, None nếu không có file"""
+        path = self.resolve(url_path)
+        if path is None:
+            return None
+        cached = self.files.get(path)
+        if cached is None or cached[0] != os.stat(path).st_mtime_ns:
+            # File mới / vừa sửa: đọc + nén trên thread, không chặn event loop
+            cached = await asyncio.to_thread(self._load, path)
+        _, variants, content_type = cached
+
+        accepted = {item.split(";")[0].strip() for item in request_headers.get("Accept-Encoding", "").split(",")}
+        encoding = next((e for e in ("br", "gzip") if e in variants and e in accepted), "identity")
+        body, etag = variants[encoding]
+        headers = [
+            ("Content-Type", content_type),
+            ("ETag", etag),
+            ("Vary", "Accept-Encoding"),
+            # html luôn hỏi lại (rẻ nhờ 304), css/js/ảnh cache 1 giờ
+            ("Cache-Control", "no-cache" if content_type.startswith("text/html") else "public, max-age=3600")
+        ]
+        if encoding != "identity":
+            headers.append(("Content-Encoding", encoding))
+
+        self.hits += 1
+        if etag_matches(request_headers, etag):
+            self.not_modified += 1
+            return response(304, headers)
+        return response(200, headers, body)
+
+    def stats(self):
+        return {
+            "files": len(self.files),
+            "hits": self.hits,
+            "not_modified": self.not_modified
+        }
@@ -0,0 +1,54 @@
+# Test thread ghi theo lô (db.WriteBehind): python -m pytest test_db.py
+import os
+import tempfile
+
+import pytest
+
+# Phải đặt trước khi import db (đọc cấu hình lúc import)
+os.environ.setdefault("CHAT_DB", os.path.join(tempfile.mkdtemp(prefix="chat-test-"), "chat.db"))
+
+import db
+
+@pytest.fixture
+def writer():
+    db.init_db()
+    db.start_writer()
+    yield db.writer
+    db.stop_writer()
+
+def test_bad_statement_does_not_stop_writer(writer):
+    # Lone surrogate: json.loads chấp nhận nhưng sqlite không encode được sang UTF-8
+    bad = db.queue_message("writer-test", "alice", "bad \ud800")
+    good = db.queue_message("writer-test", "alice", "ok")
+    with pytest.raises(UnicodeEncodeError):
+        bad.result(timeout=5)
+    assert good.result(timeout=5) > 0
+
+    later = db.queue_message("writer-test", "alice", "sau đó")
+    assert later.result(timeout=5) > good.result()
+    assert writer.thread.is_alive()
+
+def test_failed_commit_rolls_back_batch(writer, monkeypatch):
+    # Commit lỗi: cả lô báo lỗi và không bị lần commit sau ghi lén vào DB
+    connect = db.sqlite3.connect
+    failing = {"left": 1}
+
+    class FlakyConnection(db.sqlite3.Connection):
+        def commit(self):
+            if failing["left"]:
+                failing["left"] -= 1
+                raise db.sqlite3.OperationalError("disk I/O error")
+            return super().commit()
+
+    db.stop_writer()
+    monkeypatch.setattr(db.sqlite3, "connect", lambda *a, **k: connect(*a, factory=FlakyConnection, **k))
+    db.start_writer()
+
+    lost = db.queue_message("rollback-test", "alice", "lost")
+    with pytest.raises(db.sqlite3.OperationalError):
+        lost.result(timeout=5)
+    kept = db.queue_message("rollback-test", "alice", "kept").result(timeout=5)
+
+    rows = db.conn.execute("SELECT message FROM messages WHERE room='rollback-test'").fetchall()
+    assert rows == [("kept",)]
+    assert kept > 0
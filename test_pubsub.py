@@ -0,0 +1,159 @@
+# Test pub/sub giữa các node (pubsub.py + broker.py): python -m pytest test_pubsub.py
+# Broker chạy bằng process riêng (python broker.py) trên cổng trống, giống khi chạy nhiều server thật.
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+import pubsub
+from pubsub import BrokerPubSub, MemoryHub, MemoryPubSub
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def run(coro):
+    return asyncio.run(asyncio.wait_for(coro, 20))
+
+class Node:
+    """1 node chat giả: ghi lại event nhận được"""
+
+    def __init__(self, name):
+        self.name = name
+        self.events = []
+        self.changed = asyncio.Event()
+
+    async def on_event(self, event):
+        self.events.append(event)
+        self.changed.set()
+
+    async def wait_for(self, kind, **fields):
+        while True:
+            for event in self.events:
+                if event["kind"] == kind and all(event.get(k) == v for k, v in fields.items()):
+                    return event
+            self.changed.clear()
+            await self.changed.wait()
+
+    def kinds(self):
+        return [e["kind"] for e in self.events]
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _start_broker(port):
+    env = dict(os.environ, CHAT_BROKER_HOST="127.0.0.1", CHAT_BROKER_PORT=str(port))
+    proc = subprocess.Popen([sys.executable, os.path.join(HERE, "broker.py")], env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(200):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            return proc
+        except OSError:
+            if proc.poll() is not None:
+                raise RuntimeError("broker.py không khởi động được")
+            time.sleep(0.02)
+    proc.kill()
+    raise RuntimeError("broker.py không nghe cổng")
+
+def _stop_broker(proc):
+    proc.kill()
+    proc.wait()
+
+@pytest.fixture
+def broker_port():
+    port = _free_port()
+    proc = _start_broker(port)
+    yield port
+    _stop_broker(proc)
+
+def test_memory_pubsub_delivers_to_other_nodes():
+    async def scenario():
+        hub = MemoryHub()
+        a, b, c = Node("a"), Node("b"), Node("c")
+        nodes = [MemoryPubSub(n.name, n.on_event, hub) for n in (a, b, c)]
+        for node in nodes:
+            await node.connect()
+
+        await a.wait_for("hello", node="c")   # node mới báo các node có sẵn
+        nodes[0].publish({"kind": "room", "room": "general", "data": {"type": "message", "message": "hi"}})
+        for receiver in (b, c):
+            event = await receiver.wait_for("room", node="a")
+            assert event["data"]["message"] == "hi"
+        assert "room" not in a.kinds()          # không tự nhận lại event của mình
+        assert nodes[1].stats.report()["count"] >= 1
+
+        await nodes[2].close()
+        await a.wait_for("node_down", node="c")
+        await b.wait_for("node_down", node="c")
+        for node in nodes[:2]:
+            await node.close()
+
+    run(scenario())
+
+def test_broker_pubsub_fans_out_across_nodes(broker_port):
+    async def scenario():
+        address = f"127.0.0.1:{broker_port}"
+        a, b, c = Node("a"), Node("b"), Node("c")
+        nodes = [pubsub.create_pubsub(n.name, n.on_event, "broker", address) for n in (a, b, c)]
+        for node in nodes:
+            await node.connect()
+        await a.wait_for("hello", node="c")
+        await b.wait_for("hello", node="c")
+
+        nodes[1].publish({"kind": "private", "user": "alice", "data": {"message": "từ b"}})
+        for receiver in (a, c):
+            event = await receiver.wait_for("private", node="b")
+            assert event["user"] == "alice" and event["data"]["message"] == "từ b"
+        assert "private" not in b.kinds()
+        assert nodes[0].stats.report()["count"] >= 1
+
+        # Node đóng kết nối: broker báo node_down cho các node còn lại
+        await nodes[2].close()
+        await a.wait_for("node_down", node="c")
+        await b.wait_for("node_down", node="c")
+        for node in nodes[:2]:
+            await node.close()
+
+    run(scenario())
+
+def test_broker_pubsub_reconnects_after_broker_restart(monkeypatch):
+    monkeypatch.setattr(pubsub, "BROKER_RECONNECT_MS", 20)
+    port = _free_port()
+    proc = _start_broker(port)
+
+    async def scenario():
+        nonlocal proc
+        address = f"127.0.0.1:{port}"
+        a, b = Node("a"), Node("b")
+        na, nb = BrokerPubSub("a", a.on_event, address), BrokerPubSub("b", b.on_event, address)
+        await na.connect()
+        await nb.connect()
+        await a.wait_for("hello", node="b")
+
+        _stop_broker(proc)
+        nb.publish({"kind": "typing", "room": "general", "user": "bob", "is_typing": True})  # mất kết nối: bỏ qua
+        await asyncio.sleep(0.2)   # để các lần thử kết nối lại bị từ chối trước khi broker chạy lại
+        proc = await asyncio.to_thread(_start_broker, port)
+
+        # Mỗi node tự kết nối lại và báo cho chính nó (reconnected) để đồng bộ lại presence
+        await a.wait_for("reconnected", node="a")
+        await b.wait_for("reconnected", node="b")
+        assert na.reconnects == 1 and nb.reconnects == 1
+
+        na.publish({"kind": "room", "room": "general", "data": {"type": "message", "message": "sau khi nối lại"}})
+        nb.publish({"kind": "room", "room": "general", "data": {"type": "message", "message": "chiều ngược lại"}})
+        assert (await b.wait_for("room", node="a"))["data"]["message"] == "sau khi nối lại"
+        assert (await a.wait_for("room", node="b"))["data"]["message"] == "chiều ngược lại"
+        assert "typing" not in a.kinds()
+        await na.close()
+        await nb.close()
+
+    try:
+        run(scenario())
+    finally:
+        _stop_broker(proc)
@@ -0,0 +1,130 @@
+# Cùng 1 bộ test cho mọi backend của repository.py:
+#   python -m pytest test_repository.py
+# SQLite chạy trên file DB tạm; MySQL chỉ chạy khi đặt CHAT_TEST_MYSQL=1 (cấu hình MYSQL_HOST,
+# MYSQL_USER, MYSQL_PASSWORD; dùng database MYSQL_DATABASE, mặc định chat_app_test).
+import asyncio
+import os
+import re
+import tempfile
+import uuid
+
+import pytest
+
+# Phải đặt trước khi import db / repository (đọc cấu hình lúc import)
+os.environ.setdefault("CHAT_DB", os.path.join(tempfile.mkdtemp(prefix="chat-test-"), "chat.db"))
+os.environ.setdefault("MYSQL_DATABASE", "chat_app_test")
+
+import repository
+from repository import MysqlRepository, SqliteRepository
+
+def run(coro):
+    return asyncio.run(coro)
+
+def _mysql_repo():
+    if os.environ.get("CHAT_TEST_MYSQL") != "1" or repository.mysql is None:
+        pytest.skip("MySQL: đặt CHAT_TEST_MYSQL=1 và cài mysql-connector-python")
+    try:
+        cnx = repository.mysql.connector.connect(
+            host=repository.MYSQL_HOST, port=repository.MYSQL_PORT,
+            user=repository.MYSQL_USER, password=repository.MYSQL_PASSWORD
+        )
+    except repository.mysql.connector.Error as e:
+        pytest.skip(f"Không kết nối được MySQL: {e}")
+    cnx.cursor().execute(f"CREATE DATABASE IF NOT EXISTS `{repository.MYSQL_DATABASE}` CHARACTER SET utf8mb4")
+    cnx.close()
+    return MysqlRepository(pool_size=4)
+
+@pytest.fixture(scope="module", params=["sqlite", "mysql"])
+def repo(request):
+    if request.param == "sqlite":
+        store = SqliteRepository()
+        store.init()
+    else:
+        store = _mysql_repo()
+    run(store.open())
+    yield store
+    run(store.close())
+
+def _name():
+    return "t" + uuid.uuid4().hex[:10]
+
+def test_users(repo):
+    alice, bob = _name(), _name()
+    assert run(repo.get_password_hash(alice)) is None
+    run(repo.create_user(alice, "hash-a"))
+    run(repo.create_user(bob, "hash-b"))
+    assert run(repo.get_password_hash(alice)) == "hash-a"
+
+    with pytest.raises(Exception):
+        run(repo.create_user(alice, "again"))
+
+    assert run(repo.set_user_role(bob, "admin"))
+    assert not run(repo.set_user_role(_name(), "admin"))
+    users = [tuple(u) for u in run(repo.list_users())]
+    assert (alice, "user") in users and (bob, "admin") in users
+    assert [u[0] for u in users] == sorted(u[0] for u in users)
+    assert ("admin", "admin") in users   # tài khoản mặc định
+
+def test_room_messages_and_pagination(repo):
+    room = _name()
+    ids = []
+    for i in range(10):
+        ids.append(run(repo.save_message(room, "alice", f"m{i}", "text" if i % 2 else "image")))
+    run(repo.save_message(_name(), "alice", "phòng khác"))
+    assert ids == sorted(ids)
+
+    latest = run(repo.load_messages(room, 4))
+    assert [m["message"] for m in latest] == ["m6", "m7", "m8", "m9"]
+    assert [m["id"] for m in latest] == ids[6:]
+    assert latest[0]["sender"] == "alice" and latest[0]["type"] == "image"
+    assert re.match(r"^\d\d:\d\d$", latest[0]["time"])
+
+    older = run(repo.load_messages(room, 4, before_id=ids[6]))
+    assert [m["id"] for m in older] == ids[2:6]
+    assert run(repo.load_messages(room, 4, before_id=ids[0])) == []
+
+    since = run(repo.load_messages_since(room, ids[7]))
+    assert [m["id"] for m in since] == ids[8:]
+    assert [m["id"] for m in run(repo.load_messages_since(room, 0, 3))] == ids[:3]
+
+def test_private_messages(repo):
+    alice, bob, carol = _name(), _name(), _name()
+    run(repo.save_private_message(alice, bob, "1"))
+    run(repo.save_private_message(bob, alice, "2"))
+    run(repo.save_private_message(alice, carol, "khác"))
+    run(repo.save_private_message(alice, bob, "3"))
+
+    both = run(repo.load_private_messages(bob, alice))
+    assert [(m["sender"], m["receiver"], m["message"]) for m in both] == [
+        (alice, bob, "1"), (bob, alice, "2"), (alice, bob, "3")
+    ]
+    assert [m["message"] for m in run(repo.load_private_messages(alice, bob, 2))] == ["2", "3"]
+
+def test_blob_meta(repo):
+    digest, thumb = uuid.uuid4().hex * 2, uuid.uuid4().hex * 2
+    assert run(repo.get_blob_meta(digest)) is None
+    run(repo.save_blob_meta(digest, "image/png", 1234))
+    run(repo.save_blob_meta(digest, "image/png", 1234))   # trùng hash: bỏ qua
+    assert run(repo.get_blob_meta(digest)) == {"mime": "image/png", "size": 1234}
+
+    assert run(repo.get_blob_variant(digest, "thumb")) is None
+    run(repo.save_blob_variant(digest, "thumb", thumb))
+    assert run(repo.get_blob_variant(digest, "thumb")) == thumb
+    run(repo.save_blob_variant(digest, "thumb", digest))  # tạo lại: ghi đè
+    assert run(repo.get_blob_variant(digest, "thumb")) == digest
+
+def test_concurrent_writes_and_reads(repo):
+    room = _name()
+
+    async def burst():
+        ids = await asyncio.gather(*(repo.save_message(room, "bob", str(i)) for i in range(50)))
+        pages = await asyncio.gather(*(repo.load_messages(room, 50) for _ in range(10)))
+        return ids, pages
+
+    ids, pages = run(burst())
+    assert len(set(ids)) == 50
+    for page in pages:
+        assert sorted(m["id"] for m in page) == sorted(ids)
+
+def test_stats(repo):
+    assert repo.stats()["backend"] == repo.name
@@ -0,0 +1,131 @@
+import hashlib
+import os
+import secrets
+import struct
+import threading
+import time
+
+from blobstore import BLOB_DIR, commit_file
+
+# Upload file lớn theo từng chunk binary, ghi thẳng ra đĩa (không giữ cả file trong RAM)
+UPLOAD_CHUNK_MAX = int(os.environ.get("UPLOAD_CHUNK_MAX", str(256 * 1024)))   # byte / chunk
+UPLOAD_MAX = int(os.environ.get("UPLOAD_MAX", str(50 * 1024 * 1024)))         # byte / file
+UPLOAD_TTL = int(os.environ.get("UPLOAD_TTL", "3600"))   # giây không có chunk mới thì hủy
+UPLOAD_DIR = os.path.join(BLOB_DIR, "incoming")          # cùng ổ đĩa với kho để rename
+
+# Frame chunk: 0x00 | upload id (16 byte) | offset (uint64 big-endian) | dữ liệu
+# Byte 0x00 không thể mở đầu 1 tin nhắn JSON / msgpack / cbor nên không nhầm với event thường
+CHUNK_MARKER = b"\x00"
+CHUNK_HEADER = struct.Struct("!c16sQ")
+
+class UploadError(Exception):
+    """Upload không hợp lệ (sai id, quá lớn, ...)"""
+
+def is_chunk_frame(raw):
+    return isinstance(raw, bytes) and raw[:1] == CHUNK_MARKER
+
+def parse_chunk(raw):
+    """Frame chunk -> (upload id dạng hex, offset, dữ liệu)"""
+    if len(raw) < CHUNK_HEADER.size:
+        raise UploadError("Chunk không hợp lệ")
+    _, upload_id, offset = CHUNK_HEADER.unpack_from(raw)
+    return upload_id.hex(), offset, memoryview(raw)[CHUNK_HEADER.size:]
+
+class Upload:
+    """Trạng thái 1 file đang upload"""
+
+    def __init__(self, upload_id, owner, name, mime, size, target, path):
+        self.id = upload_id
+        self.owner = owner
+        self.name = name
+        self.mime = mime
+        self.size = size
+        self.target = target      # {"room": ...} hoặc {"to": ...}
+        self.path = path
+        self.received = 0
+        self.hasher = hashlib.sha256()
+        self.lock = threading.Lock()
+        self.touched = time.monotonic()
+
+    @property
+    def complete(self):
+        return self.received == self.size
+
+class UploadManager:
+    """Quản lý các upload đang dở, cho phép nối tiếp sau khi mất kết nối"""
+
+    def __init__(self, directory=UPLOAD_DIR, max_size=UPLOAD_MAX, ttl=UPLOAD_TTL):
+        self.directory = directory
+        self.max_size = max_size
+        self.ttl = ttl
+        self.uploads = {}         # upload id -> Upload
+        self.completed = 0
+        self.expired = 0
+
+    def start(self, owner, name, mime, size, target, upload_id=None):
+        """Bắt đầu upload mới, hoặc nối tiếp upload cũ của cùng user nếu có upload_id"""
+        self.sweep()
+        if upload_id:
+            upload = self.uploads.get(upload_id)
+            if upload is None or upload.owner != owner:
+                raise UploadError("Upload không tồn tại hoặc đã hết hạn")
+            upload.touched = time.monotonic()
+            return upload
+
+        if not isinstance(size, int) or not 0 < size <= self.max_size:
+            raise UploadError(f"Kích thước file phải từ 1 byte đến {self.max_size} byte")
+        os.makedirs(self.directory, exist_ok=True)
+        upload_id = secrets.token_bytes(16).hex()
+        path = os.path.join(self.directory, upload_id + ".part")
+        open(path, "wb").close()
+        upload = self.uploads[upload_id] = Upload(upload_id, owner, name, mime, size, target, path)
+        return upload
+
+    def write(self, upload_id, offset, data):
+        """Ghi 1 chunk (chạy ở thread). Chunk không đúng offset thì bỏ qua, client gửi lại từ upload.received"""
+        upload = self.uploads.get(upload_id)
+        if upload is None:
+            raise UploadError("Upload không tồn tại hoặc đã hết hạn")
+        if len(data) > UPLOAD_CHUNK_MAX:
+            raise UploadError("Chunk quá lớn")
+
+        with upload.lock:
+            upload.touched = time.monotonic()
+            if offset != upload.received:
+                return upload
+            if upload.received + len(data) > upload.size:
+                self.abort(upload_id)
+                raise UploadError("Dữ liệu vượt quá kích thước đã khai báo")
+            with open(upload.path, "ab") as f:
+                f.write(data)
+            upload.hasher.update(data)
+            upload.received += len(data)
+            if upload.complete:
+                # Bỏ khỏi danh sách ngay để chunk gửi trùng không kết thúc upload 2 lần
+                del self.uploads[upload_id]
+        return upload
+
+    def finish(self, upload):
+        """Upload đủ dữ liệu -> chuyển vào blob store, trả về hash (chạy ở thread)"""
+        self.completed += 1
+        return commit_file(upload.path, upload.hasher.hexdigest())
+
+    def abort(self, upload_id):
+        upload = self.uploads.pop(upload_id, None)
+        if upload and os.path.exists(upload.path):
+            os.unlink(upload.path)
+
+    def sweep(self):
+        """Hủy các upload bị bỏ dở quá UPLOAD_TTL"""
+        deadline = time.monotonic() - self.ttl
+        for upload_id in [u.id for u in self.uploads.values() if u.touched < deadline]:
+            self.abort(upload_id)
+            self.expired += 1
+
+    def stats(self):
+        return {
+            "active": len(self.uploads),
+            "bytes_on_disk": sum(u.received for u in self.uploads.values()),
+            "completed": self.completed,
+            "expired": self.expired
+        }
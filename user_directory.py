@@ -0,0 +1,87 @@
+import os
+import secrets
+from collections import deque
+
+# Danh bạ user trong RAM: nạp 1 lần, cập nhật khi đăng ký / đổi role
+DIRECTORY_LOG = int(os.environ.get("DIRECTORY_LOG", "1000"))  # số thay đổi giữ lại để gửi delta
+
+class UserDirectory:
+    """Danh sách user + role có số phiên bản, client chỉ nhận phần thay đổi"""
+
+    def __init__(self, loader=None, log_size=DIRECTORY_LOG):
+        self.loader = loader        # loader() -> [(username, role), ...], None = nạp bằng fill()
+        self.users = None           # username -> role
+        self.sorted = None          # cache danh sách đã sắp xếp (None = cần tạo lại)
+        self.epoch = secrets.token_hex(4)  # đổi mỗi lần khởi động: version cũ của node khác không dùng được
+        self.version = 0
+        self.log = deque(maxlen=log_size)  # (version, username, role)
+        self.full = 0
+        self.deltas = 0
+        self.unchanged = 0
+
+    def _ensure(self):
+        if self.users is None:
+            self.fill(self.loader() if self.loader else ())
+
+    def fill(self, rows):
+        """Nạp toàn bộ danh bạ (rows đọc sẵn từ repository)"""
+        self.users = dict(rows)
+        self.sorted = None
+
+    def exists(self, username):
+        self._ensure()
+        return username in self.users
+
+    def role(self, username):
+        self._ensure()
+        return self.users.get(username, "user")
+
+    def upsert(self, username, role):
+        """Thêm user mới / đổi role"""
+        self._ensure()
+        if self.users.get(username) == role:
+            return
+        self.users[username] = role
+        self.sorted = None
+        self.version += 1
+        self.log.append((self.version, username, role))
+
+    def tag(self):
+        """Phiên bản gửi cho client (kèm epoch của process)"""
+        return f"{self.epoch}:{self.version}"
+
+    def listing(self):
+        """Toàn bộ danh sách [username, role] theo thứ tự tên"""
+        self._ensure()
+        if self.sorted is None:
+            self.sorted = sorted([username, role] for username, role in self.users.items())
+        return self.sorted
+
+    def diff(self, tag):
+        """Phần client còn thiếu so với phiên bản tag: unchanged / delta / full"""
+        self._ensure()
+        epoch, _, version = str(tag or "").partition(":")
+        if epoch == self.epoch and version.isdigit():
+            since = int(version)
+            if since == self.version:
+                self.unchanged += 1
+                return {"version": self.tag(), "unchanged": True}
+            if since < self.version and self.log and self.log[0][0] <= since + 1:
+                changes = {}
+                for change_version, username, role in self.log:
+                    if change_version > since:
+                        changes[username] = role
+                self.deltas += 1
+                return {"version": self.tag(), "delta": sorted([u, r] for u, r in changes.items())}
+
+        self.full += 1
+        return {"version": self.tag(), "users": self.listing()}
+
+    def stats(self):
+        return {
+            "users": len(self.users or ()),
+            "version": self.version,
+            "full": self.full,
+            "deltas": self.deltas,
+            "unchanged": self.unchanged
+        }